@@ -0,0 +1,642 @@
+#!/usr/bin/env python3
+
+"""Benchmarks for detect_003.py helpers, runs on any Linux box (no camera or Hailo needed).
+
+python3 bench_003.py pipeline
+python3 bench_003.py detections
+python3 bench_003.py mask
+python3 bench_003.py ui
+python3 bench_003.py trigger [--stall 0.5]
+python3 bench_003.py recorder
+python3 bench_003.py scheduler
+python3 bench_003.py motion [--video clip.mp4]
+python3 bench_003.py async
+python3 bench_003.py zoom
+python3 bench_003.py review
+python3 bench_003.py timestamp
+python3 bench_003.py overlay
+python3 bench_003.py encoder
+python3 bench_003.py replay [--stream detect_stream.bin --visits visits.txt]
+"""
+
+import argparse
+import os
+import threading
+import time
+import cv2
+import numpy as np
+from detect_lib import AsyncInference, BoxOverlay, EncoderManager, FakeCamera, FakeHailo, FrameMasker, InferenceScheduler, MaskGrid, MaskOutline, MotionGate, OverlayChain, Pipeline, Recorder, ReviewRenderer, TimestampOverlay, Tracker, TriggerEffects, TriggerRules, UIRenderer, ZoomView, allowed_classes, decode_detections, det_dtype, read_stream
+
+# serial loop vs staged pipeline, with a slow ui / storage step every 10 frames
+def bench_pipeline(args):
+    stall = 0.25
+
+    camera = FakeCamera((640, 640), args.fps)
+    hailo  = FakeHailo((640, 640, 3), args.latency)
+    count  = 0
+    start  = time.monotonic()
+    while time.monotonic() - start < args.seconds:
+        frame = camera.capture_array('lores')
+        hailo.run(frame)
+        count += 1
+        if count % 10 == 0:
+            time.sleep(stall)
+    print("serial   : inference %.1f fps" % (count / (time.monotonic() - start)))
+
+    camera = FakeCamera((640, 640), args.fps)
+    decided = [0]
+    def decide(ts, frame, detections):
+        if ts is not None:
+            decided[0] += 1
+    def slow_ui():
+        time.sleep(stall)
+    pipeline = Pipeline(camera, hailo.run, decide)
+    pipeline.start()
+    start = time.monotonic()
+    n = 0
+    while time.monotonic() - start < args.seconds:
+        pipeline.run_ui(0.04)
+        n += 1
+        if n % 10 == 0:
+            pipeline.ui(slow_ui)
+    pipeline.stop()
+    print("pipeline : " + pipeline.report())
+
+# the per-detection python loop detect_003.py used before decode_detections
+def extract_detections(hailo_output, w, h, class_names, threshold=0.5):
+    results = []
+    for class_id, detections in enumerate(hailo_output):
+        for detection in detections:
+            score = detection[4]
+            if score >= threshold:
+                y0, x0, y1, x1 = detection[:4]
+                bbox = (int(x0 * w), int(y0 * h), int(x1 * w), int(y1 * h))
+                results.append([class_names[class_id], bbox, score])
+    return results
+
+# random NMS outputs, 80 classes with up to per_class detections each
+def fake_nms(rng, per_class):
+    out = []
+    for c in range(80):
+        n = rng.integers(0, per_class + 1)
+        d = rng.random((n, 5), dtype=np.float32)
+        d[:, 2:4] = np.maximum(d[:, 0:2], d[:, 2:4])
+        out.append(d)
+    return out
+
+def bench_detections(args):
+    rng = np.random.default_rng(1)
+    class_names = ["class%d" % c for c in range(80)]
+    allowed = allowed_classes(["class15", "class16", "class21"], class_names)
+    for per_class in (0, 1, 5):
+        outputs = [fake_nms(rng, per_class) for i in range(200)]
+        t0 = time.perf_counter()
+        for out in outputs:
+            extract_detections(out, 1088, 1088, class_names, 0.5)
+        t1 = time.perf_counter()
+        for out in outputs:
+            decode_detections(out, 1088, 1088, allowed, 0.5)
+        t2 = time.perf_counter()
+        print("up to %d per class: loop %.3f ms, vectorized %.3f ms per frame"
+              % (per_class, 1000 * (t1 - t0) / len(outputs), 1000 * (t2 - t1) / len(outputs)))
+
+# time fn() in ms
+def timeit(fn, n=200):
+    fn()
+    t0 = time.perf_counter()
+    for i in range(n):
+        fn()
+    return 1000 * (time.perf_counter() - t0) / n
+
+# masked inference input at 640x640, old frame * fmask vs FrameMasker
+def bench_mask(args):
+    frame = np.random.default_rng(1).integers(0, 255, (640, 640, 3), dtype=np.uint8)
+    mask  = np.ones((640, 640, 3), dtype=np.uint8)
+    mask[100:300, 200:400] = 0
+    fmask  = np.flipud(np.rot90(mask))
+    fmaskf = fmask.astype(np.float64)
+    masker = FrameMasker(fmask)
+    print("unmasked (no copy) : %.3f ms" % timeit(lambda: frame))
+    print("frame * fmask      : %.3f ms" % timeit(lambda: frame * fmask))
+    print("frame * float mask : %.3f ms" % timeit(lambda: frame * fmaskf))
+    print("FrameMasker.apply  : %.3f ms" % timeit(lambda: masker.apply(frame)))
+
+# text() as detect_003.py used to draw it, new font each call and a full display update
+def bench_ui(args):
+    os.environ.setdefault('SDL_VIDEODRIVER', 'dummy')
+    import pygame
+    pygame.init()
+    surface = pygame.display.set_mode((480, 640), 0, 24)
+    font_path = '/usr/share/fonts/truetype/freefont/FreeSerif.ttf'
+    msgs = ["0:00:%02d" % (i % 60) for i in range(60)]
+    n = [0]
+    def old_text():
+        msg = msgs[n[0] % 60]
+        n[0] += 1
+        if os.path.exists(font_path):
+            fontObj = pygame.font.Font(font_path, 17)
+        else:
+            fontObj = pygame.font.Font(None, 17)
+        pygame.draw.rect(surface, (130, 130, 130), pygame.Rect(82, 541, 76, 17))
+        surface.blit(fontObj.render(msg, False, (255, 255, 0)), (85, 540))
+        pygame.display.update()
+    ui = UIRenderer(surface)
+    def new_text():
+        msg = msgs[n[0] % 60]
+        n[0] += 1
+        pygame.draw.rect(surface, (130, 130, 130), pygame.Rect(82, 541, 76, 17))
+        surf = ui.label(msg, (255, 255, 0), 17)
+        surface.blit(surf, (85, 540))
+        ui.update(pygame.Rect(80, 540, 80, 18).union(surf.get_rect(topleft=(85, 540))))
+        ui.flush()
+    print("text() old : %.3f ms" % timeit(old_text, 500))
+    print("text() new : %.3f ms" % timeit(new_text, 500))
+    pygame.quit()
+
+class FakeClock:
+    def __init__(self):
+        self.now = 0.0
+
+    def __call__(self):
+        return self.now
+
+# records (time, value) each time it is set, like a gpiozero PWMOutputDevice
+class FakeBuzzer:
+    def __init__(self, clock):
+        self.clock   = clock
+        self.changes = []
+
+    @property
+    def value(self):
+        return self.changes[-1][1] if self.changes else 0
+
+    @value.setter
+    def value(self, v):
+        self.changes.append((self.clock(), v))
+
+# the pipeline decision stage, deciding like detect_003 with the real rules, tracker, recorder
+# and TriggerEffects on a fake clock, fed one result at a time. Run with an instant and then a
+# slow still save (--stall seconds). Checks the stage keeps taking frames while the save is
+# pending, and that recordings start and stop on the same frames either way
+def bench_trigger(args):
+    stream, spans = fake_stream(np.random.default_rng(1), frames=3000, visits=4)
+    class_names = ["class%d" % c for c in range(80)]
+    runs = {}
+    for stall in (0.0, args.stall):
+        clock   = FakeClock()
+        buzzer  = FakeBuzzer(clock)
+        effects = TriggerEffects(clock)
+        effects.start()
+        rules    = TriggerRules(class_names, class_names, args.score_thresh, args.extend)
+        tracker  = Tracker(args.confirm, args.window)
+        recorder = Recorder(post_roll=args.hold, clock=clock)
+        events, saving, decided = [], [], threading.Event()
+        def save(n):
+            saving.append((n, time.perf_counter()))
+            time.sleep(stall)
+            saving[-1] += (time.perf_counter(),)
+        def decide(ts, frame, dets):
+            if ts is None:
+                return
+            clock.now = ts
+            effects.run_due()
+            dets = rules.keep(dets)
+            best = rules.start(tracker.update(dets))
+            if best is None and recorder.state != "idle" and len(dets) != 0:
+                best = dets[0]
+            event = recorder.update(best is not None)
+            if event == "start":
+                effects.pulse(buzzer, 0.01, 0.5)
+            if event in ("start", "rollover"):
+                effects.submit(save, frame)
+            if event is not None:
+                events.append((frame, event))
+            decided.set()
+        pipeline = Pipeline(None, None, decide)
+        pipeline.running = True
+        stage = threading.Thread(target=pipeline._guard, args=(pipeline._decision,), daemon=True)
+        stage.start()
+        fed = []
+        for n, dets in enumerate(stream):
+            decided.clear()
+            t0 = time.perf_counter()
+            pipeline.results.put((n / args.fps, n, dets))
+            assert decided.wait(2), "frame %d not decided" % n
+            fed.append((t0, time.perf_counter() - t0))
+        effects.wait()
+        pipeline.stop()
+        assert pipeline.error is None and pipeline.results.dropped == 0
+        # frames handed to the decision stage while a still was being saved
+        pending = [t for t0, t in fed if any(a <= t0 < b for n, a, b in saving)]
+        on = buzzer.changes[1][0] - buzzer.changes[0][0]
+        print("save %.1fs : %d frames decided, %d while a save was pending, slowest %.1f ms, %d events, buzzer on %.2fs"
+              % (stall, len(fed), len(pending), 1000 * max(t for t0, t in fed), len(events), on))
+        assert abs(on - 0.5) <= 1 / args.fps
+        runs[stall] = (events, pending)
+    events, pending = runs[args.stall]
+    assert args.stall == 0 or len(pending) > 0, "no frames decided while a save was pending"
+    assert max(pending, default=0) < 0.1, "decision stage held up by the save"
+    assert events == runs[0.0][0] and any(e == "stop" for n, e in events), "recording timing changed"
+    print("ok, recordings start and stop on the same frames: %s" % events)
+
+# a made up stream at 25 fps: visits of a moving object with missed frames and
+# partly hidden spells, and one or two frame false positives of another class
+def fake_stream(rng, frames=9000, visits=8, false_rate=0.01):
+    stream = [[] for i in range(frames)]
+    spans = []
+    for start in np.sort(rng.choice(np.arange(0, frames - 300, 300), visits, replace=False)):
+        length = int(rng.integers(50, 250))
+        spans.append((int(start), int(start) + length))
+        x, y, vx = rng.integers(100, 600), rng.integers(100, 800), rng.normal(0, 4)
+        for f in range(start, start + length):
+            if rng.random() < 0.8:
+                x0 = int(x + vx * (f - start))
+                score = rng.normal(0.75, 0.1) if (f - start) % 100 < 60 else rng.normal(0.5, 0.05)
+                stream[f].append((15, min(0.99, score), (x0, y, x0 + 200, y + 150)))
+    for f in np.nonzero(rng.random(frames) < false_rate)[0]:
+        x, y = rng.integers(0, 900, 2)
+        for g in range(f, min(frames, f + rng.integers(1, 3))):
+            stream[g].append((74, rng.uniform(0.65, 0.95), (x, y, x + 60, y + 60)))
+    out = []
+    for rows in stream:
+        dets = np.zeros(len(rows), dtype=det_dtype)
+        for i, (c, s, b) in enumerate(sorted(rows, key=lambda r: -r[1])):
+            dets[i] = (c, s, b)
+        out.append(dets)
+    return out, spans
+
+# (start, end) frames of the recordings a stream makes, each runs hold frames past
+# its last trigger. trigger(dets, recording) says if a frame starts or extends one
+def replay(stream, trigger, hold):
+    recs = []
+    for f, dets in enumerate(stream):
+        recording = bool(recs) and f < recs[-1][1]
+        if trigger(dets, recording):
+            if recording:
+                recs[-1][1] = f + hold
+            else:
+                recs.append([f, f + hold])
+    return recs
+
+# trigger precision on a recorded (log_stream = 1) or made up detection stream,
+# single frame triggering as detect_003.py did before vs the tracker and trigger rules
+def bench_replay(args):
+    if args.stream:
+        stream = read_stream(args.stream)
+        spans = []
+        if args.visits:
+            with open(args.visits) as f:
+                spans = [tuple(int(v) for v in line.split()[:2]) for line in f if line.strip()]
+    else:
+        stream, spans = fake_stream(np.random.default_rng(1))
+    class_names = ["class%d" % c for c in range(80)]
+    hold = int(args.hold * args.fps)
+    def tracked(rules):
+        tracker = Tracker(args.confirm, args.window)
+        def trigger(dets, recording):
+            dets = rules.keep(dets)
+            tracks = tracker.update(dets)
+            return rules.start(tracks) is not None or (recording and len(dets) > 0)
+        return trigger
+    t0 = time.perf_counter()
+    extended = replay(stream, tracked(TriggerRules(class_names, class_names, args.score_thresh, args.extend)), hold)
+    ms = 1000 * (time.perf_counter() - t0) / len(stream)
+    confirmed = replay(stream, tracked(TriggerRules(class_names, class_names, args.score_thresh)), hold)
+    single = replay(stream, lambda dets, recording: len(dets) > 0 and dets[0]['score'] > args.score_thresh, hold)
+    runs = (("single frame", single), ("%d of %d" % (args.confirm, args.window), confirmed),
+            ("+ extend %.2f" % args.extend, extended))
+    print("%d frames, %d visits, rules and tracker %.3f ms per frame" % (len(stream), len(spans), ms))
+    for name, recs in runs:
+        if spans:
+            # a recording is a true trigger if it starts during a visit
+            good = [s for s, e in recs if any(a <= s < b for a, b in spans)]
+            found = sum(any(s < b and a < e for s, e in recs) for a, b in spans)
+            covered = sum(max(0, min(b, e) - max(a, s)) for a, b in spans for s, e in recs)
+            print("%-13s : %d recordings, precision %.2f, %d of %d visits recorded, %.0f%% of visit frames"
+                  % (name, len(recs), len(good) / max(len(recs), 1), found, len(spans),
+                     100 * covered / max(sum(b - a for a, b in spans), 1)))
+        else:
+            print("%-13s : %d recordings starting at frames %s" % (name, len(recs), [s for s, e in recs][:20]))
+
+# recorder events on a fake clock at 25 fps: a 2 minute visit with short gaps, a 12s gap,
+# then a 20s visit. 60s max clip length, 15s post-roll
+def bench_recorder(args):
+    clock = FakeClock()
+    recorder = Recorder(post_roll=15, max_length=60, clock=clock)
+    active = [(10, 130), (142, 162)]
+    clips = 0
+    t0 = time.perf_counter()
+    n = 0
+    while clock.now < 200:
+        t = clock.now
+        triggered = any(a <= t < b for a, b in active) and int(t * 2) % 7 != 0
+        event = recorder.update(triggered)
+        if event is not None:
+            clips += event in ("start", "rollover")
+            print("%6.2fs %s" % (t, event))
+        clock.now += 1.0 / args.fps
+        n += 1
+    us = 1e6 * (time.perf_counter() - t0) / n
+    print("%d clips, %.1f us per update" % (clips, us))
+
+# synthetic lores frames: a fixed textured scene with sensor noise, and a square
+# crossing it while visiting(t)
+def synthetic_frames(rng, size=640):
+    scene = cv2.GaussianBlur(rng.integers(0, 255, (size, size, 3), dtype=np.uint8), (9, 9), 0)
+    def frame_at(t, visiting):
+        frame = cv2.add(scene, rng.integers(0, 4, scene.shape, dtype=np.uint8))
+        if visiting:
+            x = int(t * 60) % (size - 80)
+            frame[200:280, x:x + 80] = (220, 180, 40)
+        return frame
+    return frame_at
+
+# inferences made by the scheduler on a fake clock at 25 fps, 120s quiet scene, 10s
+# visit with detections, 120s quiet again. Plus the real cost of the motion gate
+def bench_scheduler(args):
+    frame_at = synthetic_frames(np.random.default_rng(1))
+    clock = FakeClock()
+    sched = InferenceScheduler(idle_fps=2, idle_after=30, motion=MotionGate(), clock=clock)
+    sched.seen = sched.moved = -1000
+    phases = [("quiet", 120, False), ("visit", 10, True), ("quiet", 120, False)]
+    for name, length, visiting in phases:
+        runs = frames = 0
+        end = clock.now + length
+        while clock.now < end:
+            frame = frame_at(clock.now, visiting)
+            frames += 1
+            if sched.should_run(frame):
+                runs += 1
+                sched.done(np.zeros(int(visiting)), args.latency)
+            clock.now += 1.0 / args.fps
+        print("%-5s %3ds : %4d of %4d frames inferred, %s mode at the end" % (name, length, runs, frames, sched.mode))
+    gate = MotionGate()
+    frame = frame_at(0, False)
+    print("MotionGate.update : %.3f ms" % timeit(lambda: gate.update(frame)))
+
+# lores frames from a recorded clip, or a synthetic quiet scene with short visits
+def frame_sequence(args, size=(640, 640)):
+    if args.video:
+        cap = cv2.VideoCapture(args.video)
+        while True:
+            ok, frame = cap.read()
+            if not ok:
+                break
+            yield cv2.cvtColor(cv2.resize(frame, size, interpolation=cv2.INTER_AREA), cv2.COLOR_BGR2RGB)
+        cap.release()
+    else:
+        frame_at = synthetic_frames(np.random.default_rng(2), size[0])
+        for n in range(int(120 * args.fps)):
+            t = n / args.fps
+            yield frame_at(t, 20 <= t % 60 < 26)
+
+# motion gate with a heartbeat on a frame sequence: frames skipped and time per stage,
+# with the whole grid enabled and with the half the synthetic visitor crosses masked off
+def bench_motion(args):
+    grid = np.ones((32, 32), dtype=bool)
+    half = grid.copy()
+    half[:16, :] = False
+    for name, g in (("no mask", grid), ("top half masked", half)):
+        clock = FakeClock()
+        sched = InferenceScheduler(idle_fps=1 / args.heartbeat, idle_after=5, motion_hold=1,
+                                   motion=MotionGate(grid=g), clock=clock)
+        sched.seen = sched.moved = -1000
+        infer = 0.0
+        for frame in frame_sequence(args):
+            if sched.should_run(frame):
+                infer += args.latency
+            clock.now += 1.0 / args.fps
+        gate = sched.gate_stats
+        print("%-15s : %d frames, %.0f%% skipped, motion gate %.3f ms per frame, inference %.1f s of %.1f s"
+              % (name, sched.frames, 100 * sched.skip_fraction(), gate.latency(), infer, sched.frames * args.latency))
+
+# inference fps with Python decoding each result, one frame at a time vs frames
+# kept in flight on the fake Hailo. 50 fps camera so the camera isn't the limit
+def bench_async(args):
+    decode_ms = 10
+    def decode(output):
+        time.sleep(decode_ms / 1000)
+        return output
+    hailo = FakeHailo((640, 640, 3), args.latency)
+    print("fake Hailo %.0f ms, decode %d ms" % (1000 * args.latency, decode_ms))
+    for window in (0, 1, 2, 3):
+        camera = FakeCamera((640, 640), 50)
+        if window == 0:
+            pipeline = Pipeline(camera, lambda frame: decode(hailo.run(frame)), lambda *a: None)
+        else:
+            pipeline = Pipeline(camera, decode, lambda *a: None, backend=AsyncInference(hailo, window))
+        pipeline.start()
+        time.sleep(args.seconds)
+        pipeline.stop()
+        s = pipeline.stats['inference']
+        print("%-11s : inference %.1f fps, %.1f ms from submit to result"
+              % ("in flight %d" % window if window else "synchronous", s.fps(), s.latency()))
+
+# zoom view of a 1088x1088 XRGB8888 main frame, as detect_003.py drew it (a captured
+# copy, converted, cropped as a surface, rotated and flipped) vs ZoomView on the buffer
+def bench_zoom(args):
+    os.environ.setdefault('SDL_VIDEODRIVER', 'dummy')
+    import pygame
+    pygame.init()
+    pygame.display.set_mode((480, 640), 0, 24)
+    rw, rh, xo, yo = 480, 480, 37, -50
+    mapped = np.random.default_rng(1).integers(0, 255, (1088, 1088, 4), dtype=np.uint8)
+    def old_zoom():
+        frame2 = mapped.copy()
+        img = cv2.cvtColor(frame2, cv2.COLOR_RGB2BGR)
+        image = pygame.surfarray.make_surface(img)
+        cropped = pygame.Surface((rw, rh))
+        cropped.blit(image, (0, 0), (int((1088 / 2) - (rw / 2)) - xo, int((1088 / 2) - (rh / 2)) - yo, rw, rh))
+        image = pygame.transform.rotate(cropped, int(90))
+        return pygame.transform.flip(image, 0, 1)
+    zview = ZoomView((rw, rh))
+    same = np.array_equal(pygame.surfarray.array3d(old_zoom()), pygame.surfarray.array3d(zview.update(mapped, xo, yo)))
+    print("old zoom      : %.3f ms" % timeit(old_zoom, 50))
+    print("ZoomView      : %.3f ms, same pixels %s, sharpness %.0f" % (timeit(lambda: zview.update(mapped, xo, yo), 50), same, zview.sharpness))
+    pygame.quit()
+
+# trigger still and mask editing review images, old conversion chain vs ReviewRenderer
+def bench_review(args):
+    os.environ.setdefault('SDL_VIDEODRIVER', 'dummy')
+    import pygame
+    import tracemalloc
+    pygame.init()
+    pygame.display.set_mode((480, 640), 0, 24)
+    rw, rh = 480, 480
+    rng   = np.random.default_rng(1)
+    frame = rng.integers(0, 255, (640, 640, 3), dtype=np.uint8)
+    mask  = MaskGrid(rng.random((32, 32)) > 0.3).expand((640, 640))
+    def old_trigger():
+        img = cv2.cvtColor(frame, cv2.COLOR_RGB2BGR)
+        image = pygame.surfarray.make_surface(img)
+        image = pygame.transform.scale(image, (rw, rh))
+        image = pygame.transform.rotate(image, int(90))
+        return pygame.transform.flip(image, 0, 1)
+    def old_mask():
+        image = cv2.cvtColor(frame, cv2.COLOR_RGB2BGR)
+        image = np.rot90(image)
+        image = np.flipud(image)
+        image = image * mask
+        image = pygame.surfarray.make_surface(image)
+        return pygame.transform.scale(image, (rw, rh))
+    masker = FrameMasker(np.flipud(np.rot90(mask)))
+    review = ReviewRenderer((rw, rh))
+    pixels = pygame.surfarray.array3d
+    same_trigger = np.array_equal(pixels(old_trigger()), pixels(review.render(frame)))
+    same_mask    = np.array_equal(pixels(old_mask()), pixels(review.render(frame, masker.mask)))
+    def peak(fn):
+        tracemalloc.start()
+        fn()
+        size = tracemalloc.get_traced_memory()[1]
+        tracemalloc.stop()
+        return size / 1e6
+    print("old trigger    : %.3f ms, peak alloc %.2f MB" % (timeit(old_trigger, 50), peak(old_trigger)))
+    print("ReviewRenderer : %.3f ms, peak alloc %.2f MB, same pixels %s" % (timeit(lambda: review.render(frame), 50), peak(lambda: review.render(frame)), same_trigger))
+    print("old mask       : %.3f ms, peak alloc %.2f MB" % (timeit(old_mask, 50), peak(old_mask)))
+    print("ReviewRenderer : %.3f ms, peak alloc %.2f MB, same pixels %s" % (timeit(lambda: review.render(frame, masker.mask), 50),
+                                                                   peak(lambda: review.render(frame, masker.mask)), same_mask))
+    pygame.quit()
+
+# apply_timestamp on a 1088x1088 XRGB main frame, strftime + rectangle + putText every frame vs TimestampOverlay
+def bench_timestamp(args):
+    origin, font, scale, colour, thickness = (20, 1088 - 25), cv2.FONT_HERSHEY_SIMPLEX, 1, (255, 255, 255), 2
+    mapped = np.random.default_rng(1).integers(0, 255, (1088, 1088, 4), dtype=np.uint8)
+    clock  = FakeClock()
+    clock.now = 1792000000.0
+    def old_stamp():
+        clock.now += 1 / 25
+        timestamp = time.strftime("%Y/%m/%d %T", time.localtime(clock()))
+        lst = list(origin)
+        lst[0] += 365
+        lst[1] -= 20
+        end_point = tuple(lst)
+        cv2.rectangle(mapped, origin, end_point, (0,0,0), -1)
+        cv2.putText(mapped, timestamp, origin, font, scale, colour, thickness)
+    stamp = TimestampOverlay(origin, font, scale, colour, thickness)
+    def new_stamp():
+        clock.now += 1 / 25
+        stamp.draw(mapped, clock())
+    print("old timestamp    : %.1f us per frame" % (timeit(old_stamp, 2500) * 1000))
+    print("TimestampOverlay : %.1f us per frame" % (timeit(new_stamp, 2500) * 1000))
+    # same pixels inside the old box, which the overlay's box contains
+    old, new = mapped.copy(), mapped.copy()
+    now = clock() + 1
+    cv2.rectangle(old, origin, (origin[0] + 365, origin[1] - 20), (0,0,0), -1)
+    cv2.putText(old, time.strftime("%Y/%m/%d %T", time.localtime(now)), origin, font, scale, colour, thickness)
+    stamp.draw(new, now)
+    box = (slice(origin[1] - 20, origin[1] + 1), slice(origin[0], origin[0] + 366))
+    print("same pixels in the old box %s, overlay box %dx%d" % (np.array_equal(old[box], new[box]), stamp.patch.shape[1], stamp.patch.shape[0]))
+
+# show_detects = 2 video overlays on a 1088x1088 XRGB main frame, rectangle + putText per box every
+# frame (draw_objects as meant) vs BoxOverlay's cached labels, then the whole chain and the stale check
+def bench_overlay(args):
+    names  = ["cat", "bird", "bear"]
+    mapped = np.random.default_rng(1).integers(0, 255, (1088, 1088, 4), dtype=np.uint8)
+    dets   = np.zeros(3, dtype=det_dtype)
+    dets['class_id'] = [0, 1, 2]
+    dets['score']    = [0.91, 0.72, 0.66]
+    dets['box']      = [[100, 120, 400, 500], [600, 80, 760, 240], [500, 600, 1000, 1080]]
+    def old_boxes():
+        for det in dets:
+            x0, y0, x1, y1 = (int(v) for v in det['box'])
+            label = f"{names[det['class_id']]} %{int(det['score'] * 100)}"
+            cv2.rectangle(mapped, (x0, y0), (x1, y1), (0, 255, 0, 0), 4)
+            cv2.putText(mapped, label, (x0 + 5, y0 + 45), cv2.FONT_HERSHEY_SIMPLEX, 2, (0, 255, 0, 0), 3, cv2.LINE_AA)
+    clock = FakeClock()
+    boxes = BoxOverlay(names, (1088, 1088), 25, 5, clock=clock)
+    def new_boxes():
+        clock.now += 1 / 25
+        boxes.publish(clock(), dets)
+        boxes.draw(mapped)
+    print("old boxes  : %.1f us per frame" % (timeit(old_boxes, 500) * 1000))
+    print("BoxOverlay : %.1f us per frame" % (timeit(new_boxes, 500) * 1000))
+    outline = MaskOutline()
+    outline.set(np.random.default_rng(2).random((32, 32)) > 0.2)
+    chain = OverlayChain(outline, boxes, TimestampOverlay((20, 1088 - 25)))
+    def new_chain():
+        clock.now += 1 / 25
+        boxes.publish(clock(), dets)
+        chain.draw(mapped)
+    print("chain      : %.1f us per frame (outline, boxes, timestamp)" % (timeit(new_chain, 500) * 1000))
+    # detections published at frame 0, drawn while at most 5 frames old
+    boxes.publish(clock(), dets)
+    drawn = []
+    for i in range(10):
+        drawn.append(boxes.draw(mapped))
+        clock.now += 1 / 25
+    print("drawn by frame age 0-9 :", "".join("x" if d else "." for d in drawn))
+
+# stand-in for CircularOutput2, records the clips opened on it
+class FakeBuffer:
+    def __init__(self, buffer_ms):
+        self.buffer_duration_ms = buffer_ms
+        self.clips = []
+
+    def open_output(self, output):
+        self.clips.append(output)
+
+    def close_output(self):
+        pass
+
+# bitrate and pre_frames changes on a fake camera running at --fps, with encoder_delay
+# seconds to stop or start an encoder. The old way closed the camera and built a new one
+def bench_encoder(args):
+    camera = FakeCamera((1088, 1088), args.fps, encoder_delay=0.05)
+    encoders = EncoderManager(camera, lambda bitrate: ("H264Encoder", bitrate), FakeBuffer, 10000000, 5000)
+    encoders.start_recording()
+    running = [True]
+    def frames():
+        while running[0]:
+            camera.capture_array('main')
+            encoders.tick()
+    t = threading.Thread(target=frames, daemon=True)
+    t.start()
+    time.sleep(0.5)
+    def calls(since):
+        return ", ".join(name for name, _ in camera.calls[since:]) or "none"
+    n = len(camera.calls)
+    encoders.set_buffer(8000)
+    print("pre_frames 5 -> 8s       : camera calls %s, buffer %dms" % (calls(n), encoders.output.buffer_duration_ms))
+    n = len(camera.calls)
+    gap = encoders.set_bitrate(12000000)
+    print("bitrate 10 -> 12M idle   : camera calls %s, gap %d frames %.0fms" % (calls(n), gap[0], gap[1] * 1000))
+    n = len(camera.calls)
+    gap = encoders.set_bitrate(12000000)
+    print("bitrate 12 -> 12M        : camera calls %s, gap %s" % (calls(n), gap))
+    assert gap == (0, 0.0) and len(camera.calls) == n
+    n = len(camera.calls)
+    encoders.open_output("clip")
+    gap = encoders.set_bitrate(8000000)
+    print("bitrate 12 -> 8M in clip : camera calls %s, waiting %s" % (calls(n), encoders.pending))
+    time.sleep(0.2)
+    encoders.close_output()
+    print("clip closed              : camera calls %s, gap %d frames %.0fms, encoder %s" % (calls(n), encoders.gap[0], encoders.gap[1] * 1000, encoders.encoder))
+    running[0] = False
+    t.join()
+    print("old bitrate change       : picam2.close, stop, new Picamera2, preview, configure, start_recording. Camera, preview and buffer gone for the restart")
+
+benches = {'pipeline': bench_pipeline, 'detections': bench_detections, 'mask': bench_mask, 'ui': bench_ui,
+           'trigger': bench_trigger, 'recorder': bench_recorder, 'scheduler': bench_scheduler, 'motion': bench_motion, 'async': bench_async, 'zoom': bench_zoom,
+           'review': bench_review, 'timestamp': bench_timestamp, 'overlay': bench_overlay, 'encoder': bench_encoder, 'replay': bench_replay}
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="detect_003 benchmarks")
+    parser.add_argument("bench", choices=list(benches) + ['all'])
+    parser.add_argument("--seconds", type=float, default=5, help="run time of timed benchmarks")
+    parser.add_argument("--fps", type=int, default=25, help="fake camera frame rate")
+    parser.add_argument("--latency", type=float, default=0.02, help="fake Hailo latency in seconds")
+    parser.add_argument("--video", help="motion, clip to read frames from")
+    parser.add_argument("--heartbeat", type=float, default=5, help="motion, seconds between frames inferred without motion")
+    parser.add_argument("--stream", help="detection stream to replay, from log_stream = 1")
+    parser.add_argument("--visits", help="text file of true visits, start and end frame per line")
+    parser.add_argument("--score_thresh", type=float, default=0.65, help="replay score threshold")
+    parser.add_argument("--confirm", type=int, default=3, help="replay, frames an object must be seen in")
+    parser.add_argument("--window", type=int, default=5, help="replay, out of this many frames")
+    parser.add_argument("--extend", type=float, default=0.45, help="replay, score that extends a recording")
+    parser.add_argument("--hold", type=float, default=2, help="replay and trigger, seconds a recording runs past its last trigger")
+    parser.add_argument("--stall", type=float, default=0.5, help="trigger, seconds the slow still save takes")
+    args = parser.parse_args()
+    for name, fn in benches.items():
+        if args.bench in (name, 'all'):
+            print("--", name)
+            fn(args)
@@ -24,7 +24,11 @@ SOFTWARE."""
 import argparse
 import cv2
 from picamera2 import MappedArray, Picamera2, Preview
-from picamera2.devices import Hailo, hailo_architecture
+try:
+    from picamera2.devices import Hailo, hailo_architecture
+except ImportError:
+    # no hailo_platform, only the cpu and replay backends work
+    Hailo = None
 from picamera2.encoders import H264Encoder
 from libcamera import controls
 from libcamera import Transform
@@ -39,6 +43,7 @@ from gpiozero import PWMOutputDevice
 import pygame, sys
 from pygame.locals import *
 import numpy as np
+from detect_lib import AsyncInference, BoxOverlay, CpuDetector, EncoderManager, FrameMasker, InferenceScheduler, MaskGrid, MaskOutline, MediaCatalog, MotionGate, OverlayChain, Pipeline, Recorder, ReplayDetector, ReviewRenderer, StorageMonitor, StorageMover, ThumbCache, TileMask, TimestampOverlay, Tracker, TriggerEffects, TriggerRules, UIRenderer, ZoomView, decode_detections, load_mask, no_detections, no_tracks, write_stream
 
 # Your Location
 your_lat     = '51.00' # set your location latitude
@@ -49,6 +54,17 @@ use_suntimes = 0       # set to 1 to use sunrise & sunset times to start recordi
 
 # detection objects
 objects = ["cat","bear","dog","clock"]
+thresholds   = {}    # score to start recording per object, eg {"cat":0.5}, others use --score_thresh
+extend_thresh = 0.45 # score that keeps a recording going, so a partly hidden object doesn't end it
+min_area     = 0     # ignore detections smaller than this, in video pixels, eg 40*40
+min_areas    = {}    # per object, eg {"bird":20*20}
+confirm_n    = 3     # trigger when an object is seen in confirm_n of the last confirm_m frames
+confirm_m    = 5
+idle_fps     = 2     # inference rate when nothing has moved or been seen for idle_after seconds, 0 = always every frame
+idle_after   = 30    # seconds
+motion_gate  = 0     # 1 = only infer frames with motion in unmasked cells, plus one every heartbeat seconds
+heartbeat    = 5     # seconds
+in_flight    = 2     # frames queued on the Hailo at once, so it works while results are decoded. 0 = one at a time
 
 # shutdown time
 sd_hour      = 0     # if sd_hour = 0 and sd_mins = 0 won't shutdown
@@ -61,19 +77,25 @@ use_buzz     = 1     # sound buzzer on capture, 0 off, 1 on starting video, 2 on
 # set variables
 screen       = 1     # 1 = 1280 x 720, 2 = 800 x 480
 show_detects = 1     # show detections, 1 = on stills, 2 = on video & stills, 0 = none
+stale_frames = 5     # with show_detects = 2, boxes aren't drawn on video once the detections are this many frames old
 log          = 0     # set to 1 to make a log of detections in detect_log.txt
+log_stream   = 0     # set to 1 to record every frame's detections in detect_stream.bin, replay with bench_003.py replay
 v_width      = 1088  # video width
 v_height     = 1088  # video height
 v_length     = 10    # seconds, minimum video length
+max_length   = 600   # seconds, longest video, a longer recording carries on in a new file
 pre_frames   = 5     # seconds, defines length of pre-detection buffer
 h_flip       = 0     # set to 1 to flip horizontally 
 v_flip       = 0     # set to 1 to flip vertically
-mp4_timer    = 10    # seconds, move MP4s to SD card after this time if no detections
+mp4_timer    = 10    # seconds, check the shutdown time this often when not recording
 mp4_anno     = 1     # show timestamps on video, 1 = yes, 0 = no
 led          = 21    # recording led gpio
 zmtime       = 30    # zoom timeout
+zoom_fps     = 10    # zoom view refresh rate
 gridmask     = 32    # resolution of masking grid, eg 4 to 64.
+mask_mode    = 0     # 0 = blank masked area before detection, 1 = ignore detections centred in masked area
 gridcolor    = (255,255,255) # mask grid color
+mask_outline = 0     # 1 = outline the masked area on video
 
 # default camera settings, note these will be overwritten if changed whilst running
 mode         = 1     # camera mode, (see modes below), 1 = normal
@@ -134,25 +156,50 @@ else: # 800 x 480
     ds = 0
     dg = 0
     
-from picamera2.outputs import CircularOutput2, PyavOutput
+from picamera2.outputs import CircularOutput2, PyavOutput, SplittableOutput
 
-# load a pre-defined mask if available 
+# PyavOutput that tells the storage monitor how much it has written,
+# and counts the video frames so the clip length is known when it's closed
+class CountingPyavOutput(PyavOutput):
+    def __init__(self, output_name, *args, **kwargs):
+        super().__init__(output_name, *args, **kwargs)
+        self.path   = output_name
+        self.frames = 0
+        self.first  = None
+        self.last   = None
+        self.base   = None
+
+    def outputframe(self, frame, keyframe=True, timestamp=None, packet=None, audio=False):
+        if frame is not None:
+            storage.written(len(frame))
+        if not audio:
+            self.frames += 1
+            if timestamp is not None:
+                if self.first is None:
+                    self.first = timestamp
+                self.last = timestamp
+        # a clip split from a long recording starts part way through, count from its first frame
+        if timestamp is not None:
+            if self.base is None:
+                self.base = timestamp
+            timestamp -= self.base
+        super().outputframe(frame, keyframe, timestamp, packet, audio)
+
+    # seconds, from the frame timestamps (us) if given
+    def duration(self, fps):
+        if self.first is not None and self.frames > 1:
+            # first to last frame, plus one frame period
+            return (self.last - self.first) / 1000000 * self.frames / (self.frames - 1)
+        return self.frames / fps
+
+# free ram space, sampled in the background
+storage = StorageMonitor("/run/shm/", ram_limit * 1100000)
+storage.start()
+
+# load a pre-defined mask if available, at the gridmask resolution it's edited at.
+# the resized mask is cached beside the bmp, so later starts skip the conversion
 if os.path.exists('Mask1.bmp'):
-    mask = cv2.imread('Mask1.bmp')
-    # convert to 0/1
-    for aa in range(0,mask.shape[0]-1):
-        for bb in range(0,mask.shape[1]-1):
-            if mask[bb][aa][0] > 128 or mask[bb][aa][1] > 128 or mask[bb][aa][2] > 128:
-                mask[bb][aa][0] = 1
-                mask[bb][aa][1] = 1
-                mask[bb][aa][2] = 1
-            else:
-                mask[bb][aa][0] = 0
-                mask[bb][aa][1] = 0
-                mask[bb][aa][2] = 0
-    mask = np.rot90(mask)
-    mask = np.flipud(mask)
-    gridmask = mask.shape[0]
+    mask = load_mask('Mask1.bmp', (gridmask, gridmask))
 
 # generate the mask if not an existing one
 elif not os.path.exists('Mask2.bmp'):
@@ -179,6 +226,7 @@ os.environ['SDL_VIDEO_WINDOW_POS'] = "%d,%d" % (x,y)
 pygame.init()
 windowSurfaceObj = pygame.display.set_mode((rw,ch),1, 24)
 pygame.display.set_caption("Review Captures" )
+ui = UIRenderer(windowSurfaceObj)
 
 # check Det_ConfigX.txt exists, if not then write default values
 config_file = "Det_Config10.txt"
@@ -298,7 +346,7 @@ def button(col,row,bw,bh,bColor):
     pygame.draw.line(windowSurfaceObj,whiteColor,(bx,by),(bx+bw-1,by),1)
     pygame.draw.line(windowSurfaceObj,dgryColor,(bx,by+bh-1),(bx+bw-1,by+bh-1),1)
     pygame.draw.line(windowSurfaceObj,dgryColor,(bx+bw-2,by),(bx+bw-2,by+bh),2)
-    pygame.display.update(bx, by, bw-1, bh)
+    ui.update((bx, by, bw-1, bh))
 
 # write text on a button
 def text(fs,col,row,line,bColor,msg):
@@ -320,17 +368,15 @@ def text(fs,col,row,line,bColor,msg):
             pygame.draw.rect(windowSurfaceObj,(10,0,0),Rect(bx+2,by+1,bw - 3,fs))
         else:
             pygame.draw.rect(windowSurfaceObj,(130,130,130),Rect(bx+2,by+1,bw - 4,fs))
+    dirty = Rect(bx,by,bw,fs + 1)
     if (screen == 1 and col == 0 and row == 12) or (screen == 2 and col == 0 and row == 11):
         pygame.draw.rect(windowSurfaceObj,(0,0,0),Rect(bx+2,by+1,bw + 152,fs))
-    if os.path.exists ('/usr/share/fonts/truetype/freefont/FreeSerif.ttf'):
-        fontObj = pygame.font.Font('/usr/share/fonts/truetype/freefont/FreeSerif.ttf',fs)
-    else:
-        fontObj = pygame.font.Font(None,fs)
-    msgSurfaceObj = fontObj.render(msg, False, (Color))
+        dirty = Rect(bx,by,bw + 154,fs + 1)
+    msgSurfaceObj = ui.label(msg, Color, fs)
     msgRectobj = msgSurfaceObj.get_rect()
     msgRectobj.topleft = (bx + 5,by)
     windowSurfaceObj.blit(msgSurfaceObj, msgRectobj)
-    pygame.display.update()
+    ui.update(dirty.union(msgRectobj))
 
 # initialise
 Users    = []
@@ -345,8 +391,13 @@ zmtimer  = time.monotonic()
 rec_led  = LED(led)
 rec_led.off()
 p        = 0
-Pics     = glob.glob(h_user + '/Pictures/*.jpg')
-Pics.sort()
+# captures catalog, reconciled with the folders once at start up
+catalog  = MediaCatalog("detect_catalog.db", h_user + '/Pictures', h_user + '/Videos')
+catalog.rescan()
+Pics     = catalog.stills()
+thumbs   = ThumbCache(h_user + '/Pictures/thumbs', (rw,rh))
+review   = ReviewRenderer((rw,rh))
+stamp    = TimestampOverlay(origin, font, scale, colour, thickness)
 record   = 0
 sd_tim   = (sd_hour * 60) + sd_mins
 zoom     = 0
@@ -476,23 +527,13 @@ def show_last():
   # show last captured image, if present  
   if len(Pics) > 0:
     p = len(Pics) - 1
-    image = pygame.image.load(Pics[p])
-    image = pygame.transform.scale(image,(rw,rh))
+    image = thumbs.get(Pics[p])
     windowSurfaceObj.blit(image,(0,bh))
     text(ft,0,13,1,4,str(p+1) + "/" + str(p+1))
     pic = Pics[p].split("/")
     pipc = h_user + '/Videos/' + pic[4][:-3] + "mp4"
-    mp4 = pic[0] + "/" + pic[1] + "/" + pic[2] + "/Videos/" + pic[4][:-4] + ".mp4"
-    cap1 = 0
-    cap = cv2.VideoCapture(mp4)
-    if not cap.isOpened():
-        time.sleep(0.1)
-    else:
-        cap1 = 1
-        fpsv = cap.get(cv2.CAP_PROP_FPS)
-        frame_count = cap.get(cv2.CAP_PROP_FRAME_COUNT)
-        duration = frame_count / fpsv if fpsv else 0
-        cap.release()
+    duration = catalog.duration(pic[4][:-4])
+    if duration is not None:
         text(ft,0,12,1,4,str(pic[4][:-4]) + ".mp4 : " + str(int(duration)) + "s")
     text(ft,5,0,1,3,"DEL ALL")
     if os.path.exists(pipc):
@@ -508,36 +549,14 @@ def show_last():
   
 show_last()
 
-def extract_detections(hailo_output, w, h, class_names, threshold=0.5):
-    """Extract detections from the HailoRT-postprocess output."""
-    results = []
-    for class_id, detections in enumerate(hailo_output):
-        for detection in detections:
-            score = detection[4]
-            if score >= threshold:
-                y0, x0, y1, x1 = detection[:4]
-                bbox = (int(x0 * w), int(y0 * h), int(x1 * w), int(y1 * h))
-                results.append([class_names[class_id], bbox, score])
-    return results
-
-def draw_objects(request): # on video & stills
-    global show_detects,v_width,v_height,model_w,model_h
-    current_detections = detections
-    if current_detections and show_detects == 2:
-        with MappedArray(request, "main") as m:
-            for class_name, bbox, score in current_detections:
-                x0, y0, x1, y1 = bbox
-                label = f"{class_name} %{int(score * 100)}"
-                cv2.rectangle(m.array, (x0, y0), (x1, y1), (0, 255, 0, 0), 4)
-                cv2.puttext(ft,m.array, label, (x0 + 5, y0 + 45),
-                            cv2.FONT_HERSHEY_SIMPLEX, 2, (0, 255, 0, 0), 3, cv2.LINE_AA)
-                            
 def draw_box(): # on stills only
     global show_detects,v_width,v_height,model_w,model_h,frame
     current_detections = detections
-    if current_detections:
-        for class_name, bbox, score in current_detections:
-            x0, y0, x1, y1 = bbox
+    if current_detections is not None and len(current_detections):
+        for det in current_detections:
+            class_name = class_names[det['class_id']]
+            score = det['score']
+            x0, y0, x1, y1 = det['box']
             x0 = int(x0 * (model_w/v_width))
             y0 = int(y0 * (model_h/v_height))
             x1 = int(x1 * (model_w/v_width))
@@ -547,40 +566,292 @@ def draw_box(): # on stills only
             cv2.putText(frame, label, (x0 + 5, y0 + 45),
                         cv2.FONT_HERSHEY_SIMPLEX, 0.8, (0, 255, 0, 0), 2, cv2.LINE_AA)
 
-# apply timestamp to videos
-def apply_timestamp(request):
-  global mp4_anno
-  if mp4_anno == 1:
-      timestamp = time.strftime("%Y/%m/%d %T")
-      with MappedArray(request, "main") as m:
-          lst = list(origin)
-          lst[0] += 365
-          lst[1] -= 20
-          end_point = tuple(lst)
-          cv2.rectangle(m.array, origin, end_point, (0,0,0), -1) 
-          cv2.putText(m.array, timestamp, origin, font, scale, colour, thickness)
+# draw the mask outline, detection boxes and timestamp on videos, camera pre_callback
+def apply_overlays(request):
+    encoders.tick()
+    if overlays.overlays:
+        with MappedArray(request, "main") as m:
+            overlays.draw(m.array)
           
+def make_encoder(bitrate):
+    return H264Encoder(bitrate, repeat=True)
+
+def make_buffer(buffer_ms):
+    return CircularOutput2(buffer_duration_ms=buffer_ms)
+
 # start circular buffer
 def start_buffer():
-    global picam2,encoding,vlen_time,circular,bitrate2,encoder,fps,model_h, model_w,video_w, video_h,pre_frames,cam1
+    global picam2,encoding,vlen_time,encoders,bitrate2,fps,model_h, model_w,video_w, video_h,pre_frames,cam1
     lsize = (model_w, model_h)
     picam2 = Picamera2()
     picam2.start_preview(Preview.QT, x=0, y=0, width=model_w, height=model_h)
     video_config = picam2.create_video_configuration(main={"size": (video_w,video_h), "format": "XRGB8888"},
                                              lores={"size": lsize, "format": "RGB888"},display="lores")
     picam2.configure(video_config)
-    encoder = H264Encoder(bitrate2, repeat=True)
-    pref = pre_frames * 1000
-    circular = CircularOutput2(buffer_duration_ms=pref)
-    picam2.pre_callback = apply_timestamp
+    # H264 encoder into the pre-detection buffer, swapped on the running camera to change bitrate
+    encoders = EncoderManager(picam2, make_encoder, make_buffer, bitrate2, pre_frames * 1000)
+    picam2.pre_callback = apply_overlays
     if cam1 == "imx708" or cam1 == 'ov64a4': # Pi v3 or Arducam 64MB OWLSIGHT cameras
         picam2.set_controls({"AfMode": controls.AfModeEnum.Continuous})
         picam2.set_controls({"AfTrigger": controls.AfTriggerEnum.Start})
     picam2.set_controls({"FrameRate": fps})
-    picam2.start_recording(encoder, circular)
+    encoders.start_recording()
     encoding = False
     vlen_time = 0
         
+# the detector for --backend, the CPU if the Hailo won't open and there's a CPU model
+def open_detector(args):
+    if args.backend == "replay":
+        print("Replaying detections from",args.replay)
+        return ReplayDetector(args.replay, (v_width, v_height))
+    if args.backend == "hailo":
+        try:
+            if Hailo is None:
+                raise RuntimeError("hailo_platform not installed")
+            return Hailo(args.model)
+        except Exception as e:
+            print("Hailo failed",e)
+            if not os.path.exists(args.cpu_model):
+                raise
+    print("Detecting on the CPU with",args.cpu_model)
+    return CpuDetector(args.cpu_model)
+
+# Run inference on a lores frame, pipeline inference stage when in_flight = 0
+def infer_frame(frame):
+    return decode_output(detector.run(infer_input(frame)))
+
+# the masked frame (mask_mode 0) to run inference on
+def infer_input(frame):
+    global start
+    if mask_mode == 0 and masker.active:
+        # add mask
+        frame3 = masker.apply(frame)
+        if start == 1:
+            # saved masked image
+            cv2.imwrite('frame3.bmp',frame3)
+            start = 0
+        return frame3
+    return frame
+
+# detections from the detector output, on the inference backend thread when in_flight > 0
+def decode_output(results):
+    # Extract detections of the wanted objects, best first
+    dets = decode_detections(results, video_w, video_h, rules.allowed, rules.floor)
+    if mask_mode == 1:
+        # drop detections in masked cells
+        dets = tiles.accept(dets, video_w, video_h)
+    return dets
+
+# compile the mask for inference (mask_mode 0) or detection filtering (mask_mode 1)
+def set_masks():
+    masker.set(np.flipud(np.rot90(mask)))
+    tiles.set(np.transpose(mgrid.grid))
+    motion.set_mask(np.transpose(mgrid.grid))
+    outline.set(np.transpose(mgrid.grid))
+
+# show the review image with the mask applied, then save and compile the mask
+def show_mask():
+    global smask,start
+    set_masks()
+    image = review.render(frame,masker.mask)
+    # draw mask grid
+    for l in range(0,gridmask):
+        pygame.draw.line(image, gridcolor, [0,l * (rw/gridmask)], [rw,l * (rw/gridmask)], 1)
+        pygame.draw.line(image, gridcolor, [l * (rh/gridmask),0], [l * (rh/gridmask),rh], 1)
+    windowSurfaceObj.blit(image,(0,bh))
+    # save mask
+    mgrid.save('Mask2.bmp')
+    smask = 1
+    start = 1
+
+# show captured lores trigger image, pipeline ui stage
+def show_trigger(frame,p,name):
+    image = review.render(frame)
+    windowSurfaceObj.blit(image,(0,bh))
+    text(ft,0,13,1,4,str(p+1) + "/" + str(p+1))
+    text(ft,0,12,1,4,name)
+    ui.update((0,bh,rw,rh))
+
+# show the DELETE / to USB / Show Video buttons for the current capture
+def show_buttons():
+    global pic
+    if len(Pics) > 0:
+        pic = Pics[p].split("/")
+        pipc = h_user + '/Videos/' + pic[4][:-3] + "mp4"
+        if os.path.exists(pipc):
+            text(ft,2,0,1,3,"DELETE")
+            text(ft,5,0,1,3,"DEL ALL")
+            if len(Pics) > 0:
+                text(ft,4,0,0,5,"Show")
+                text(ft,4,0,2,5,"Video")
+            USB_Files  = []
+            USB_Files  = (os.listdir(m_user))
+            if len(USB_Files) > 0:
+                text(ft,3,0,1,4,"  to USB")
+        else:
+            text(ft,2,0,1,3,"    ")
+            text(ft,5,0,1,3,"    ")
+            text(ft,3,0,1,4,"    ")
+            text(ft,4,0,0,5,"    ")
+            text(ft,4,0,2,5,"     ")
+    else:
+        text(ft,2,0,1,3,"    ")
+        text(ft,5,0,1,3,"    ")
+        text(ft,3,0,1,4,"    ")
+        text(ft,4,0,0,5,"    ")
+        text(ft,4,0,2,5,"     ")
+
+# a clip has been moved from ram to the SD card, pipeline ui stage
+def clip_moved(path):
+    with pipeline.lock:
+        catalog.add_clip(os.path.basename(path)[:-4], os.path.getsize(path))
+        show_buttons()
+
+# save a trigger still, effects worker
+def save_trigger(timestamp,tframe,obj,value):
+    still = h_user + "/Pictures/" + timestamp + ".jpg"
+    cv2.imwrite(still,tframe)
+    thumbs.make(still,tframe)
+    pipeline.ui(trigger_saved,timestamp,tframe,obj,value)
+
+# add a saved trigger still to the review list and show it, pipeline ui stage
+def trigger_saved(timestamp,tframe,obj,value):
+    global p,pic
+    with pipeline.lock:
+        catalog.add_still(timestamp, obj, value)
+        p = len(Pics) - 1
+        pic = Pics[p].split("/")
+        show_trigger(tframe,p,str(pic[4]))
+
+# clip files, effects worker so they're opened, split and closed in order.
+# CircularOutput2 feeds a SplittableOutput, which can switch to a new file at a keyframe
+def open_clip(path):
+    global clip_out,clip_split
+    clip_out = CountingPyavOutput(path)
+    clip_split = SplittableOutput(clip_out)
+    encoders.open_output(clip_split)
+
+def split_clip(path):
+    global clip_out
+    old = clip_out
+    clip_out = CountingPyavOutput(path)
+    # returns once the old file is closed
+    clip_split.split_output(clip_out)
+    clip_done(old)
+
+def close_clip():
+    encoders.close_output()
+    clip_done(clip_out)
+
+# new bitrate, effects worker so it's after any clip is closed. Waits for the clip if one is open
+def change_bitrate(bitrate):
+    gap = encoders.set_bitrate(bitrate)
+    if gap is None:
+        print("Bitrate " + str(bitrate) + " from the next recording")
+    elif gap == (0, 0.0):
+        print("Bitrate " + str(bitrate) + " unchanged")
+    else:
+        print("Bitrate " + str(bitrate) + ", encoder swapped in " + str(int(gap[1] * 1000)) + "ms, " + str(gap[0]) + " frames lost")
+
+# note a closed clip's length, then move it to the SD card
+def clip_done(out):
+    catalog.set_clip_info(os.path.basename(out.path)[:-4], out.duration(fps), out.frames, codec="h264")
+    mover.move(out.path)
+
+# start / stop recording, pipeline decision stage.
+# called with the latest detections, or with Nones when no new frame has arrived
+def decide(ts,lframe,dets):
+    global frame,detections,record,startmp4,encoding,sta,clip,nframe,trig,sched_mode
+    if ts is not None:
+        frame = lframe
+        detections = rules.shown(dets)
+        boxes.publish(ts,detections)
+        if log_stream == 1:
+            write_stream(stream_file,nframe,dets)
+        nframe += 1
+        # wanted objects, big enough and above their extend score, followed over frames
+        dets = rules.keep(dets)
+        tracks = tracker.update(dets)
+    else:
+        dets = no_detections
+        tracks = no_tracks
+
+    # detection, a confirmed object above its start score starts a recording,
+    # any wanted detection keeps one going
+    best = rules.start(tracks)
+    if best is None and encoding and len(dets) != 0:
+        best = dets[0]
+    triggered = best is not None or record == 1
+    if triggered:
+        if best is not None:
+            trig = (class_names[best['class_id']], float(best['score']))
+        else:
+            trig = ("manual", 0)
+        startmp4 = time.monotonic()
+        record = 0
+        if show_detects == 1:
+            draw_box()
+        pipeline.ui(text,ft,1,13,1,6,"________")
+        pipeline.ui(text,ft,1,13,2,6,"________")
+        pipeline.ui(text,ft,1,13,0,5,"Recording")
+        if log == 1:
+            now = datetime.datetime.now()
+            timestamp = now.strftime("%y%m%d_%H%M%S")
+            with open("detect_log.txt", 'a') as f:
+                f.write(timestamp + " " + trig[0] + "\n" )
+        # don't start before sunrise
+        if not encoding and use_suntimes == 1:
+            now = datetime.datetime.now()
+            sr_time = now.replace(hour=int(sr_hour),minute=int(sr_mins), second=1, microsecond=0)
+            triggered = now > sr_time
+
+    # note inference slowing down when idle, or back to full rate
+    if scheduler is not None and scheduler.mode != sched_mode:
+        sched_mode = scheduler.mode
+        print("Inference",pipeline.report())
+
+    # start, extend, roll over or stop the recording, stops if low RAM
+    recorder.post_roll = v_length + pre_frames
+    event = recorder.update(triggered, storage.has_headroom())
+    if event is None:
+        return
+    now = datetime.datetime.now()
+    timestamp = now.strftime("%y%m%d_%H%M%S")
+    if event == "start" or event == "rollover":
+        clip = "/run/shm/" + timestamp + ".mp4"
+        if event == "start":
+            sta = time.monotonic()
+            effects.submit(open_clip,clip)
+            encoding = True
+            if scheduler is not None:
+                scheduler.recording = True
+            print("New  Detection",timestamp + " " + trig[0])
+            rec_led.on()
+            # sound buzzer, switched off by the effects timer
+            if use_buzz == 1:
+                effects.pulse(buzzer,0.01,0.5)
+        else:
+            # carry on in a new file from the next keyframe
+            effects.submit(split_clip,clip)
+            print("New  Clip",timestamp)
+        # save lores image and show it, without holding up detection
+        effects.submit(save_trigger,timestamp,frame,trig[0],trig[1])
+    elif event == "stop":
+        print("Stopped Record", timestamp)
+        effects.submit(close_clip)
+        encoding = False
+        if scheduler is not None:
+            scheduler.recording = False
+        startmp4 = time.monotonic()
+        rec_led.off()
+        pipeline.ui(text,ft,0,12,1,4,os.path.basename(clip))
+        pipeline.ui(text,ft,1,13,0,4,"          ")
+        pipeline.ui(text,ft,1,13,1,4,"          ")
+        pipeline.ui(text,ft,1,13,2,4,"          ")
+        pipeline.ui(text,ft,1,13,1,3,"RECORD")
+    else:
+        print(event.capitalize(), timestamp)
+
 # main loop
 if __name__ == "__main__":
 
@@ -589,7 +860,7 @@ if __name__ == "__main__":
     
     # Parse command-line arguments.
     parser = argparse.ArgumentParser(description="Detection Example")
-    if hailo_architecture() == 'HAILO10H':
+    if Hailo is not None and hailo_architecture() == 'HAILO10H':
         parser.add_argument("-m", "--model", help="Path for the HEF model.",
                         default="/usr/share/hailo-models/yolov8m_h10.hef")
     else:
@@ -599,33 +870,61 @@ if __name__ == "__main__":
                         help="Path to a text file containing labels.")
     parser.add_argument("-s", "--score_thresh", type=float, default=0.65,
                         help="Score threshold, must be a float between 0 and 1.")
+    parser.add_argument("-b", "--backend", choices=["hailo", "cpu", "replay"], default="hailo",
+                        help="Run detection on the Hailo, on the CPU (also used if the Hailo fails), or replay recorded detections.")
+    parser.add_argument("--cpu_model", default="yolov8s.onnx",
+                        help="Path for the ONNX model, for the cpu backend.")
+    parser.add_argument("--replay", default="detect_stream.bin",
+                        help="Path for recorded detections (log_stream = 1), for the replay backend.")
     args = parser.parse_args()
 
-    # Get the Hailo model, the input size it wants, and the size of our preview stream.
-    with Hailo(args.model) as hailo:
-        model_h, model_w, _ = hailo.get_input_shape()
+    # Get the detector, the input size it wants, and the size of our preview stream.
+    with open_detector(args) as detector:
+        model_h, model_w, _ = detector.get_input_shape()
         video_w, video_h    = v_width,v_height
-        # determine if a mask set
-        maskoff = np.all(mask)
-        # resize mask to hailo model
-        mask = cv2.resize(mask, (model_h, model_w), interpolation=cv2.INTER_AREA) 
-        fmask = np.rot90(mask)
-        fmask = np.flipud(fmask)
+        # mask grid being edited, and the mask resized to hailo model
+        mgrid = MaskGrid(mask[:,:,0])
+        if os.path.exists('Mask1.bmp'):
+            mask = load_mask('Mask1.bmp', (model_h, model_w))
+        else:
+            mask = mgrid.expand((model_h, model_w))
+        # mask in lores frame layout, applied into a reused buffer
+        masker = FrameMasker(buffers=max(1,in_flight))
+        tiles  = TileMask()
+        motion = MotionGate()
+        outline = MaskOutline()
+        set_masks()
         
         # Load class names from the labels file
         with open(args.labels, 'r', encoding="utf-8") as f:
             class_names = f.read().splitlines()
+        # which detections start and extend recordings, and the tracker confirming them
+        rules = TriggerRules(objects, class_names, args.score_thresh, extend_thresh, thresholds, min_area, min_areas)
+        tracker = Tracker(confirm_n, confirm_m)
+        recorder = Recorder(v_length + pre_frames, max_length)
+        nframe = 0
+        if log_stream == 1:
+            stream_file = open("detect_stream.bin", 'ab', buffering=0)
 
         # The list of detected objects to draw.
         detections = None
+        # The latest decided frame, None until the first one, for the mask view.
+        frame = None
+        # overlays on the video, later ones drawn on top
+        boxes = BoxOverlay(class_names, (video_w, video_h), fps, stale_frames)
+        overlays = OverlayChain()
+        if mask_outline == 1:
+            overlays.add(outline)
+        if show_detects == 2:
+            overlays.add(boxes)
+        if mp4_anno == 1:
+            overlays.add(stamp)
 
         # Configure and start Picamera2.
         x = 0
         if x == 0:
             start_buffer()
             x = 1
-            if show_detects == 2:
-                picam2.pre_callback = draw_objects
             if cam1 == "imx708" or cam1 == 'ov64a4': # Pi v3 or Arducam 64MB OWLSIGHT cameras
                 controls2 = {'FrameRate': fps,"AfMode": controls.AfModeEnum.Continuous,"AfTrigger": controls.AfTriggerEnum.Start}
             else:
@@ -668,159 +967,72 @@ if __name__ == "__main__":
             elif meter == 2:
                 picam2.set_controls({"AeMeteringMode": controls.AeMeteringModeEnum.Matrix})
             sta = time.monotonic()
+            last_td = ""
             
-            # Process each low resolution camera frame.
+            # trigger stills and buzzer, run beside the pipeline
+            effects = TriggerEffects()
+            effects.start()
+
+            # start the capture, inference and decision stages
+            # infer every frame while there's motion in unmasked cells, a recent detection or a recording,
+            # else idle_fps. motion_gate only infers frames with motion, plus a heartbeat
+            if motion_gate == 1:
+                scheduler = InferenceScheduler(1 / heartbeat, idle_after, motion, motion_hold=1)
+            elif idle_fps > 0:
+                scheduler = InferenceScheduler(idle_fps, idle_after, motion)
+            else:
+                scheduler = None
+            sched_mode = "full"
+            if in_flight > 0:
+                backend = AsyncInference(detector, in_flight)
+                pipeline = Pipeline(picam2, decode_output, decide, scheduler=scheduler, backend=backend, prepare=infer_input)
+            else:
+                pipeline = Pipeline(picam2, infer_frame, decide, scheduler=scheduler)
+            pipeline.start()
+
+            # move clips to the SD card in the background, including any left in ram
+            mover = StorageMover(h_user + '/Videos/', lambda path: pipeline.ui(clip_moved, path))
+            mover.start()
+            for clip in sorted(glob.glob('/run/shm/*.mp4')):
+                mover.move(clip)
+
+            # focus view for zoom
+            zview = ZoomView((rw,rh), zoom_fps)
+
+            # ui stage, runs queued ui updates and handles mouse presses
             while True:
-                # get free ram space
-                st = os.statvfs("/run/shm/")
-                freeram = (st.f_bavail * st.f_frsize)/1100000
-                
-                # capture lores frame
-                frame = picam2.capture_array('lores')
-                
-                # show zoomed image to assist focussing
-                if zoom == 1:
-                    frame2 = picam2.capture_array('main')
-                    img = cv2.cvtColor(frame2,cv2.COLOR_RGB2BGR)
-                    image = pygame.surfarray.make_surface(img)
-                    cropped = pygame.Surface((rw, rh))
-                    cropped.blit(image, (0, 0), (int((v_width/2)-(rw/2)) - xo, int((v_height/2)-(rh/2)) - yo, rw, rh))
-                    image = pygame.transform.rotate(cropped,int(90))
-                    image = pygame.transform.flip(image,0,1)
-					windowSurfaceObj.blit(image,(0,bh))
+                pipeline.run_ui(0.04)
+                pipeline.paused = (zoom == 1)
+
+                # show zoomed image to assist focussing, cropped straight from the camera buffer
+                if zoom == 1 and zview.due():
+                    with picam2.captured_request() as request:
+                        with MappedArray(request, 'main') as m:
+                            image = zview.update(m.array, xo, yo)
+                    windowSurfaceObj.blit(image,(0,bh))
+                    ui.update((0,bh,rw,rh))
                     text(ft,1,0,1,4,"ZOOMED")
-                    pygame.display.update()
-                else:
-                    if maskoff == False:
-						# add mask
-                        frame3 = frame * fmask
-                        # Run inference on the masked frame
-                        results = hailo.run(frame3)
-                        if start == 1:
-							# saved masked image
-                            cv2.imwrite('frame3.bmp',frame3)
-                            start = 0
-                    else:
-						# Run inference on the frame
-                        results = hailo.run(frame)
-               
-                # Extract detections from the inference results
-                detections = extract_detections(results, video_w, video_h, class_names, args.score_thresh)
-                
-                # detection
-                for d in range(0,len(objects)):
-                    if len(detections) != 0 or record == 1:
-                        if len(detections) != 0:
-                            value = float(detections[0][2])
-                            obj = detections[0][0]
-                        else:
-                            value = 0
-                            obj = "manual"
-                            objects[d] = "manual"
-                        if (value > args.score_thresh and value < 1 and obj == objects[d]) or record == 1:
-                            startrec = time.monotonic()
-                            startmp4 = time.monotonic()
-                            record = 0
-                            if show_detects == 1:
-                                draw_box()
-                            text(ft,1,13,1,6,"________")
-                            text(ft,1,13,2,6,"________")
-                            text(ft,1,13,0,5,"Recording")
-                            if log == 1:
-                                now = datetime.datetime.now()
-                                timestamp = now.strftime("%y%m%d_%H%M%S")
-                                with open("detect_log.txt", 'a') as f:
-                                    f.write(timestamp + " " + objects[d] + "\n" )
-                            # start recording
-                            if not encoding and freeram > ram_limit:
-                                now = datetime.datetime.now()
-                                sr_time = now.replace(hour=int(sr_hour),minute=int(sr_mins), second=1, microsecond=0)
-                                if use_suntimes == 0 or (use_suntimes == 1 and now > sr_time):
-                                    sta = time.monotonic()
-                                    timestamp = now.strftime("%y%m%d_%H%M%S")
-                                    circular.open_output(PyavOutput("/run/shm/" + timestamp +".mp4"))
-                                    encoding = True
-                                    print("New  Detection",timestamp + " " + objects[d])
-                                    rec_led.on()
-                                    # sound buzzer
-                                    if use_buzz == 1:
-                                        buzzer.value = 0.01
-                                    # save lores image
-                                    cv2.imwrite(h_user + "/Pictures/" + str(timestamp) + ".jpg",frame)
-                                    # show captured lores trigger image
-                                    Pics = glob.glob(h_user + '/Pictures/*.jpg')
-                                    Pics.sort()
-                                    p = len(Pics) - 1
-                                    img = cv2.cvtColor(frame,cv2.COLOR_RGB2BGR)
-                                    image = pygame.surfarray.make_surface(img)
-                                    image = pygame.transform.scale(image,(rw,rh))
-                                    image = pygame.transform.rotate(image,int(90))
-                                    image = pygame.transform.flip(image,0,1)
-                                    windowSurfaceObj.blit(image,(0,bh))
-                                    text(ft,0,13,1,4,str(p+1) + "/" + str(p+1))
-                                    pic = Pics[p].split("/")
-                                    text(ft,0,12,1,4,str(pic[4]))
-                                    pygame.display.update()
-                                    time.sleep(0.5)
-                                    if use_buzz == 1:
-                                        buzzer.value = 0
-                
-                # show recording time                   
+                    # sharpness, higher is better focussed
+                    text(ft,1,0,2,4,"F " + str(int(zview.sharpness)))
+
+                # show recording time, when it changes
                 if encoding:
-                    td = timedelta(seconds=int(time.monotonic()-sta))
-                    text(ft,1,13,2,5,str(td))
-                    
-                # stop recording, if time out or low RAM
-                if encoding and (time.monotonic() - startrec > v_length + pre_frames or freeram <= ram_limit):
-                    now = datetime.datetime.now()
-                    timestamp2 = now.strftime("%y%m%d_%H%M%S")
-                    print("Stopped Record", timestamp2)
-                    circular.close_output()
-                    encoding = False
-                    startmp4 = time.monotonic()
-                    rec_led.off()
-                    text(ft,0,12,1,4,str(pic[4][:-4] + ".mp4"))
-                    text(ft,1,13,0,4,"          ")
-                    text(ft,1,13,1,4,"          ")
-                    text(ft,1,13,2,4,"          ")
-                    text(ft,1,13,1,3,"RECORD")
-
-                # move mp4s from RAM to SD card
+                    td = str(timedelta(seconds=int(time.monotonic()-sta)))
+                    if td != last_td:
+                        text(ft,1,13,2,5,td)
+                        last_td = td
+                else:
+                    last_td = ""
+
+                # draw this loop's screen changes
+                ui.flush()
+
+                # check shutdown time. The decision stage isn't held off here, recording state
+                # it shares is only changed with pipeline.lock held for the change itself
                 if time.monotonic() - startmp4 > mp4_timer and not encoding:
-                    startmp4 = time.monotonic()
-                    Videos = glob.glob('/run/shm/*.mp4')
-                    Videos.sort()
-                    for xx in range(0,len(Videos)):
-                        if not os.path.exists(h_user + "/" + '/Videos/' + Videos[xx]):
-                            shutil.move(Videos[xx], h_user + '/Videos/')
-                    Pics = glob.glob(h_user + '/Pictures/*.jpg')
-                    Pics.sort()
-                    if len(Pics) > 0:
-                        pic = Pics[p].split("/")
-                        pipc = h_user + '/Videos/' + pic[4][:-3] + "mp4"
-                        if os.path.exists(pipc):
-                            text(ft,2,0,1,3,"DELETE")
-                            text(ft,5,0,1,3,"DEL ALL")
-                            if len(Pics) > 0:
-                                text(ft,4,0,0,5,"Show")
-                                text(ft,4,0,2,5,"Video")
-                            USB_Files  = []
-                            USB_Files  = (os.listdir(m_user))
-                            if len(USB_Files) > 0:
-                                text(ft,3,0,1,4,"  to USB")
-                        else:
-                            text(ft,2,0,1,3,"    ")
-                            text(ft,5,0,1,3,"    ")
-                            text(ft,3,0,1,4,"    ")
-                            text(ft,4,0,0,5,"    ")
-                            text(ft,4,0,2,5,"     ")
-                    else:
-                        text(ft,2,0,1,3,"    ")
-                        text(ft,5,0,1,3,"    ")
-                        text(ft,3,0,1,4,"    ")
-                        text(ft,4,0,0,5,"    ")
-                        text(ft,4,0,2,5,"     ")
-                        
+                    with pipeline.lock:
+                        startmp4 = time.monotonic()
+
                     # auto time shutdown
                     if sd_tim != 0:
                         # check if clock synchronised
@@ -837,22 +1049,21 @@ if __name__ == "__main__":
                         now = datetime.datetime.now()
                         sd_time = now.replace(hour=int(sd_hour),minute=int(sd_mins), second=0, microsecond=0)
                         if now >= sd_time and time.monotonic() - start_up > 300 and synced == 1:
-                            # move jpgs and mp4s to USB if present
-                            time.sleep(2 * mp4_timer)
+                            # move jpgs and mp4s to USB if present, once the stills are saved and the clips are out of ram
+                            effects.wait()
+                            mover.wait()
+                            pipeline.run_ui()
                             USB_Files  = []
                             USB_Files  = (os.listdir(m_user))
                             if len(USB_Files) > 0:
                                 usedusb = os.statvfs(m_user + "/" + USB_Files[0] + "/")
                                 USB_storage = ((1 - (usedusb.f_bavail / usedusb.f_blocks)) * 100)
                             if len(USB_Files) > 0 and USB_storage < 90:
-                                Videos = glob.glob(h_user + '/Videos/*.mp4')
-                                Videos.sort()
+                                Videos = catalog.clips()
                                 for xx in range(0,len(Videos)):
                                     movi = Videos[xx].split("/")
                                     if not os.path.exists(m_user + "/" + USB_Files[0] + "/Videos/" + movi[4]):
                                         shutil.move(Videos[xx],m_user + "/" + USB_Files[0] + "/Videos/")
-                                Pics = glob.glob(h_user + '/Pictures/*.jpg')
-                                Pics.sort()
                                 for xx in range(0,len(Pics)):
                                     pic = Pics[xx].split("/")
                                     if not os.path.exists(m_user + "/" + USB_Files[0] + "/Pictures/" + pic[4]):
@@ -890,83 +1101,19 @@ if __name__ == "__main__":
                                     w = 1
                                 else:
                                     w = 0
-                                for aa in range(0,model_w - 1):
-                                    for bb in range(0,model_h - 1):
-                                        mask[bb][aa][0] = w
-                                        mask[bb][aa][1] = w
-                                        mask[bb][aa][2] = w
+                                mgrid.fill(w)
                                 if w == 0:
-                                    mx = int(mousex * (model_w/rw))
-                                    my = int((mousey - bh) * (model_h/rh))
-                                    mz = int(model_w/gridmask)
-                                    mxc = ((int(mx/mz)) * mz)
-                                    myc = ((int(my/mz)) * mz)
-                                    for aa in range(0,mz):
-                                        for bb in range(0,mz):
-                                            mask[mxc + bb][myc + aa][0] = 1
-                                            mask[mxc + bb][myc + aa][1] = 1
-                                            mask[mxc + bb][myc + aa][2] = 1
-                            # show image
-                            image = cv2.cvtColor(frame,cv2.COLOR_RGB2BGR)
-                            image = np.rot90(image)
-                            image = np.flipud(image)
-                            image = image * mask
-                            image = pygame.surfarray.make_surface(image)
-                            image = pygame.transform.scale(image,(rw,rh))
-                            # draw mask grid
-                            for l in range(0,gridmask):
-                                pygame.draw.line(image, gridcolor, [0,l * (rw/gridmask)], [rw,l * (rw/gridmask)], 1)
-                                pygame.draw.line(image, gridcolor, [l * (rh/gridmask),0], [l * (rh/gridmask),rh], 1)
-                            windowSurfaceObj.blit(image,(0,bh))
-                            # save mask
-                            nmask = cv2.resize(mask,(gridmask,gridmask), interpolation = cv2.INTER_AREA)
-                            cv2.imwrite('Mask2.bmp',nmask)
-                            smask = 1
-                            start = 1
-                            fmask = np.rot90(mask)
-                            fmask = np.flipud(fmask)
-                            maskoff = np.all(mask)
-                        
+                                    mgrid.toggle(*mgrid.cell(mousex,mousey - bh,rw,rh))
+                                mask = mgrid.expand((model_h, model_w))
+                            show_mask()
+                            
                         # set mask (left click on review window)
                         elif mousey > bh and mousey < bh + rh and event.button == 1 and zoom == 0:
                             if smask == 1:
-                                mz = int(model_w/gridmask)
-                                mx = int(mousex * (model_w/rw))
-                                my = int((mousey - bh) * (model_h/rh))
-                                mxc = ((int(mx/mz)) * mz)
-                                myc = ((int(my/mz)) * mz)
-                                # generate mask square
-                                if mask[mx][my][0] == 0:
-                                    for aa in range(0,mz):
-                                        for bb in range(0,mz):
-                                            mask[mxc + bb][myc + aa][0] = 1
-                                            mask[mxc + bb][myc + aa][1] = 1
-                                            mask[mxc + bb][myc + aa][2] = 1
-                                else:
-                                    for aa in range(0,mz):
-                                        for bb in range(0,mz):
-                                            mask[mxc + bb][myc + aa][0] = 0
-                                            mask[mxc + bb][myc + aa][1] = 0
-                                            mask[mxc + bb][myc + aa][2] = 0
-                            image = cv2.cvtColor(frame,cv2.COLOR_RGB2BGR)
-                            image = np.rot90(image)
-                            image = np.flipud(image)
-                            image = image * mask
-                            image = pygame.surfarray.make_surface(image)
-                            image = pygame.transform.scale(image,(rw,rh))
-                            # draw mask grid
-                            for l in range(0,gridmask):
-                                pygame.draw.line(image, gridcolor, [0,l * (rw/gridmask)], [rw,l * (rw/gridmask)], 1)
-                                pygame.draw.line(image, gridcolor, [l * (rh/gridmask),0], [l * (rh/gridmask),rh], 1)
-                            windowSurfaceObj.blit(image,(0,bh))
-                            # save mask
-                            nmask = cv2.resize(mask,(gridmask,gridmask), interpolation = cv2.INTER_AREA)
-                            cv2.imwrite('Mask2.bmp',nmask)
-                            smask = 1
-                            start = 1
-                            fmask = np.rot90(mask)
-                            fmask = np.flipud(fmask)
-                            maskoff = np.all(mask)
+                                # toggle mask square
+                                mgrid.toggle(*mgrid.cell(mousex,mousey - bh,rw,rh))
+                                mask = mgrid.expand((model_h, model_w))
+                            show_mask()
                             
                         # SHOW ZOOM 
                         elif bcol == 1 and brow == 0:
@@ -978,13 +1125,15 @@ if __name__ == "__main__":
                                 zoom = 0
                                 pygame.draw.rect(windowSurfaceObj,(0,0,0),Rect(0,bh,rw,rh))
                                 text(ft,1,0,1,5,"    Zoom")
+                                text(ft,1,0,2,5,"        ")
                                 show_last()
                                 
                         # RECORD VIDEO (right click)  
                         elif bcol == 1 and brow == 13:
                             smask = 0
                             if event.button == 3 and not encoding:
-                                record = 1
+                                with pipeline.lock:
+                                    record = 1
 
                         elif bcol == 2 and brow == 13 and event.button == 2:
                             use_suntimes +=1
@@ -1061,11 +1210,8 @@ if __name__ == "__main__":
                             else:
                                 pre_frames -=1
                                 pre_frames = max(pre_frames,1)
-                            text(ft,3,13,2,1,str(pre_frames))
-                            picam2.stop_recording()
-                            pref = pre_frames * 1000
-                            circular = CircularOutput2(buffer_duration_ms=pref)
-                            picam2.start_recording(encoder, circular)
+                            # buffer length is changed live, keeping what's buffered
+                            effects.submit(encoders.set_buffer,pre_frames * 1000)
                             text(ft,3,13,2,4,str(pre_frames))
                             
                         # Video length
@@ -1082,9 +1228,7 @@ if __name__ == "__main__":
                             if event.button == 3 or event.button == 4:
                                 use_buzz = 1
                                 text(ft,5,13,2,4,"ON")
-                                buzzer.value = 0.01
-                                time.sleep(0.5)
-                                buzzer.value = 0
+                                effects.pulse(buzzer,0.01,0.5)
                             else:
                                 use_buzz = 0
                                 text(ft,5,13,2,4,"OFF")
@@ -1166,11 +1310,8 @@ if __name__ == "__main__":
                                 bitrate -=1
                                 bitrate = max(1,bitrate)
                             bitrate2 = bitrate * 1000000
-                            # stop circular buffer
-                            picam2.close()
-                            picam2.stop()
-                            # restart circular buffer
-                            start_buffer()
+                            # swap the encoder, the camera keeps running
+                            effects.submit(change_bitrate,bitrate2)
                             save_config = 1
                             text(ft,2,14,2,4,str(bitrate))
                             
@@ -1298,77 +1439,64 @@ if __name__ == "__main__":
                         elif (bcol == 0 and brow == 0 and event.button == 1) or (smask == 1 and mousey > bh and mousey < bh + rh and (event.button == 3) and zoom == 0):
                             smask = 0
                             pygame.draw.rect(windowSurfaceObj,(0,0,0),Rect(0,bh,rw,rh))
-                            Pics = glob.glob(h_user + '/Pictures/*.jpg')
-                            Pics.sort()
                             p -= 1
                             if p < 0:
                                 p = 0
                             if len(Pics) > 0:
-                                image = pygame.image.load(Pics[p])
-                                image = pygame.transform.scale(image,(rw,rh))
+                                image = thumbs.get(Pics[p])
                                 windowSurfaceObj.blit(image,(0,bh))
                                 text(ft,0,13,1,4,str(p+1) + "/" + str(p+1))
                                 pic = Pics[p].split("/")
                                 text(ft,0,12,1,4,str(pic[4]))
                                 pygame.display.update()
+                                thumbs.prefetch(Pics, p)
                                 
                         # show next
                         elif bcol == 0 and brow == 0 and event.button == 3:
                             smask = 0
                             pygame.draw.rect(windowSurfaceObj,(0,0,0),Rect(0,bh,rw,rh))
-                            Pics = glob.glob(h_user + '/Pictures/*.jpg')
-                            Pics.sort()
                             p += 1
                             if p > len(Pics)-1:
                                 p = len(Pics)-1
                             if len(Pics) > 0:
-                                image = pygame.image.load(Pics[p])
-                                image = pygame.transform.scale(image,(rw,rh))
+                                image = thumbs.get(Pics[p])
                                 windowSurfaceObj.blit(image,(0,bh))
                                 text(ft,0,13,1,4,str(p+1) + "/" + str(p+1))
                                 pic = Pics[p].split("/")
                                 text(ft,0,12,1,4,str(pic[4]))
                                 pygame.display.update()
+                                thumbs.prefetch(Pics, p)
                                 
                         # delete picture and video
                         elif bcol == 2 and brow == 0 and event.button == 3:
                             smask = 0
                             pygame.draw.rect(windowSurfaceObj,(0,0,0),Rect(0,bh,rw,rh))
-                            Pics = glob.glob(h_user + '/Pictures/*.jpg')
-                            Pics.sort()
-                            Videos = glob.glob(h_user + '/Videos/*.mp4')
-                            Videos.sort()
                             if len(Pics) > 0:
                                 pic = Pics[p].split("/")
                                 pipc = h_user + '/Videos/' + pic[4][:-3] + "mp4"
                                 if os.path.exists(pipc):
+                                   thumbs.forget(Pics[p])
                                    os.remove(Pics[p])
-                                   if len(Videos) > 0:
-                                       os.remove(pipc)
-                                       print("DELETED", pipc)
-                                Videos = glob.glob(h_user + '/Videos/*.mp4')
-                                Videos.sort()
-                                Pics = glob.glob(h_user + '/Pictures/*.jpg')
-                                Pics.sort()
+                                   os.remove(pipc)
+                                   print("DELETED", pipc)
+                                   catalog.refresh(pic[4][:-4])
                             if p > len(Pics) - 1:
                                 p -= 1
                             if len(Pics) > 0:
-                                image = pygame.image.load(Pics[p])
-                                image = pygame.transform.scale(image,(rw,rh))
+                                image = thumbs.get(Pics[p])
                                 windowSurfaceObj.blit(image,(0,bh))
                             pygame.display.update()
                             
                         # delete ALL Pictures and Videos
                         elif bcol == 5 and brow == 0 and event.button == 3:
                             smask = 0
-                            Videos = glob.glob(h_user + '/Videos/*.mp4')
-                            Videos.sort()
+                            Videos = catalog.clips()
                             for w in range(0,len(Videos)):
                                 os.remove(Videos[w])
-                            Pics = glob.glob(h_user + '/Pictures/*.jpg')
-                            Pics.sort()
                             for w in range(0,len(Pics)):
+                                thumbs.forget(Pics[w])
                                 os.remove(Pics[w])
+                            catalog.clear()
                             pygame.draw.rect(windowSurfaceObj,(0,0,0),Rect(0,bh,rw,rh))
                             p = 0
                             text(ft,2,0,1,3,"    ")
@@ -1381,10 +1509,6 @@ if __name__ == "__main__":
                         elif bcol == 3 and brow == 0 and event.button != 3:
                             smask = 0
                             pygame.draw.rect(windowSurfaceObj,(0,0,0),Rect(0,40,rw,rh))
-                            Pics = glob.glob(h_user + '/Pictures/*.jpg')
-                            Pics.sort()
-                            Videos = glob.glob(h_user + '/Videos/*.mp4')
-                            Videos.sort()
                             if len(Pics) > 0:
                               try:
                                 pic = Pics[p].split("/")
@@ -1407,12 +1531,10 @@ if __name__ == "__main__":
                                     if os.path.exists(pipc):
                                         vid = pipc.split("/")
                                         if not os.path.exists(m_user + "/" + USB_Files[0] + "/Videos/" + vid[4]):
-                                            shutil.move(Videos[p],m_user + "/" + USB_Files[0] + "/Videos/")
+                                            shutil.move(pipc,m_user + "/" + USB_Files[0] + "/Videos/")
+                                    catalog.refresh(pic[4][:-4])
+                                    thumbs.prune(Pics)
                                     
-                                Videos = glob.glob(h_user + '/Videos/*.mp4')
-                                Videos.sort()
-                                Pics = glob.glob(h_user + '/Pictures/*.jpg')
-                                Pics.sort()
                                 if len(Pics) > 0 and len(USB_Files) > 0:
                                     text(ft,3,0,1,4,"  to USB")
                               except:
@@ -1420,8 +1542,7 @@ if __name__ == "__main__":
                             if p > len(Pics) - 1:
                                 p -= 1
                             if len(Pics) > 0:
-                                image = pygame.image.load(Pics[p])
-                                image = pygame.transform.scale(image,(rw,rh))
+                                image = thumbs.get(Pics[p])
                                 windowSurfaceObj.blit(image,(0,bh))
 
                             pygame.display.update()
@@ -1429,10 +1550,7 @@ if __name__ == "__main__":
                         # move ALL pictures and videos to USB
                         elif bcol == 3 and brow == 0 and event.button == 3:
                             smask = 0
-                            Pics = glob.glob(h_user + '/Pictures/*.jpg')
-                            Pics.sort()
-                            Videos = glob.glob(h_user + '/Videos/*.mp4')
-                            Videos.sort()
+                            Videos = catalog.clips()
                             if len(Pics) > 0 or len(Videos) > 0:
                               try:
                                 # move mp4s and jpgs to USB if present, and USB storage < 90% full
@@ -1451,8 +1569,7 @@ if __name__ == "__main__":
                                     for w in range(0,len(Videos)):
                                         text(ft,0,13,1,4,str(w+1) + "/" + str(len(Videos)))
                                         vid = Videos[w].split("/")
-                                        image = pygame.image.load("/" + vid[1] + "/" + vid[2] + "/Pictures/" + vid[4][:-3] + "jpg")
-                                        image = pygame.transform.scale(image,(rw,rh))
+                                        image = thumbs.get("/" + vid[1] + "/" + vid[2] + "/Pictures/" + vid[4][:-3] + "jpg")
                                         windowSurfaceObj.blit(image,(0,bh))
                                         pygame.display.update()
                                         if not os.path.exists(m_user + "/" + USB_Files[0] + "/Videos/" + vid[4]):
@@ -1462,18 +1579,15 @@ if __name__ == "__main__":
                                         if not os.path.exists(m_user + "/" + USB_Files[0] + "/Pictures/" + pic[4]):
                                             shutil.move(Pics[w],m_user + "/" + USB_Files[0] + "/Pictures/")
                                     text(ft,3,0,1,4,"  to USB")
-                                Videos = glob.glob(h_user + '/Videos/*.mp4')
-                                Videos.sort()
-                                Pics = glob.glob(h_user + '/Pictures/*.jpg')
-                                Pics.sort()
                               except:
                                   pass
+                              catalog.rescan()
+                              thumbs.prune(Pics)
                             if p > len(Pics) - 1:
                                 p -= 1
                             pygame.draw.rect(windowSurfaceObj,(0,0,0),Rect(0,bh,rw,rh))
                             if len(Pics) > 0:
-                                image = pygame.image.load(Pics[p])
-                                image = pygame.transform.scale(image,(rw,rh))
+                                image = thumbs.get(Pics[p])
                                 windowSurfaceObj.blit(image,(0,bh))
                             pygame.display.update()
 
@@ -1481,7 +1595,7 @@ if __name__ == "__main__":
                         elif bcol == 10 and brow == 0 and event.button == 3:
                           if os.path.exists('mylist.txt'):
                               os.remove('mylist.txt')
-                          Videos = glob.glob(h_user + '/Videos/******_******.mp4')
+                          Videos = catalog.clips()
                           Rideos = glob.glob('/run/shm/*.mp4')
                           for x in range(0,len(Rideos)):
                               Videos.append(Rideos[x])
@@ -1490,7 +1604,6 @@ if __name__ == "__main__":
                                   os.remove(Videos[w])
                           Videos.sort()
                           if len(Videos) > 0:
-                              frame = 0
                               if os.path.exists('mylist.txt'):
                                 os.remove('mylist.txt')
                               for w in range(0,len(Videos)):
@@ -1519,13 +1632,16 @@ if __name__ == "__main__":
                                 for x in range(0,len(txtconfig)):
                                     if os.path.exists(txtconfig[x] ) and txtconfig[x][len(txtconfig[x]) - 5:] != "f.mp4":
                                         os.remove(txtconfig[x] )
+                                        catalog.remove_clip(os.path.basename(txtconfig[x])[:-4])
                                 while not os.path.exists(outfile):
                                     time.sleep(0.1)
                                 os.rename (h_user + '/Videos/' + str(nam[len(nam)-1])[:-4] + "f.mp4",h_user + '/Videos/' + str(nam[len(nam)-1])[:-4] + ".mp4")
-                                Pics = glob.glob(h_user + '/Pictures/*.jpg')
-                                for x in range(0,len(Pics)):
-                                    if Pics[x] != h_user + '/Pictures/' + str(nam[len(nam)-1])[:-4] + ".jpg":
-                                        os.remove(Pics[x])
+                                catalog.add_clip(str(nam[len(nam)-1])[:-4], os.path.getsize(h_user + '/Videos/' + str(nam[len(nam)-1])[:-4] + ".mp4"))
+                                # Pics is the catalog's list, so go through a copy
+                                for still in list(Pics):
+                                    if still != h_user + '/Pictures/' + str(nam[len(nam)-1])[:-4] + ".jpg":
+                                        os.remove(still)
+                                        catalog.remove_still(os.path.basename(still)[:-4])
                                 p = 0
                                 txtvids = []
                                 #move MP4 to usb (if present)
@@ -1534,8 +1650,7 @@ if __name__ == "__main__":
                                 if len(USB_Files) > 0:
                                     if not os.path.exists(m_user + "/'" + USB_Files[0] + "'/Videos/") :
                                         os.system('mkdir ' + m_user + "/'" + USB_Files[0] + "'/Videos/")
-                                    Videos = glob.glob(h_user + '/Videos/******_******.mp4')
-                                    Videos.sort()
+                                    Videos = catalog.clips()
                                     for xx in range(0,len(Videos)):
                                         movi = Videos[xx].split("/")
                                         if os.path.exists(m_user + "/" + USB_Files[0] + "/Videos/" + movi[4]):
@@ -1543,17 +1658,19 @@ if __name__ == "__main__":
                                         shutil.copy(Videos[xx],m_user + "/" + USB_Files[0] + "/Videos/")
                                         if os.path.exists(m_user + "/" + USB_Files[0] + "/Videos/" + movi[4]):
                                              os.remove(Videos[xx])
-                                             Pics = glob.glob(h_user + '/Pictures/*.jpg')
-                                             for x in range(0,len(Pics)):
-                                                 os.remove(Pics[x])
-                              Videos = glob.glob(h_user + '/Videos/******_******.mp4')
+                                             catalog.remove_clip(movi[4][:-4])
+                                             for still in list(Pics):
+                                                 if os.path.exists(still):
+                                                     os.remove(still)
+                                                 catalog.remove_still(os.path.basename(still)[:-4])
+                              Videos = catalog.clips()
                               USB_Files  = (os.listdir(m_user))
-                              Videos.sort()
                               w = 0
                               USB_Files  = (os.listdir(m_user))
                               if len(USB_Files) > 0:
                                   usedusb = os.statvfs(m_user + "/" + USB_Files[0] + "/")
                                   USB_storage = ((1 - (usedusb.f_bavail / usedusb.f_blocks)) * 100)
+                          thumbs.prune(Pics)
                                   
                         # Capture Screenshot
                         elif bcol == 4 and brow == 0 and event.button == 3:
@@ -1562,16 +1679,10 @@ if __name__ == "__main__":
                         # Show Video
                         elif bcol == 4 and brow == 0 and event.button != 3 and len(Pics) > 0:
                             smask = 0
-                            Videos = glob.glob(h_user + '/Videos/******_******.mp4')
-                            Videos.sort()
                             pic = Pics[p].split("/")
                             vid = "/"+ pic[1] + "/" + pic[2] + "/Videos/" + pic[4][:-4] + ".mp4"
                             if os.path.exists(vid):
                                os.system("vlc " + vid)
-                        Videos = glob.glob(h_user + '/Videos/******_******.mp4')
-                        Videos.sort()
-                        Pics = glob.glob(h_user + '/Pictures/*.jpg')
-                        Pics.sort()
                         if len(Pics) > 0:
                             pic = Pics[p].split("/")
                             pipc = h_user + '/Videos/' + pic[4][:-3] + "mp4"
@@ -1594,15 +1705,10 @@ if __name__ == "__main__":
                             pic = Pics[p].split("/")
                             text(ft,0,13,1,4,str(p+1) + "/" + str(len(Pics)))
                             pic = Pics[p].split("/")
-                            mp4 = pic[0] + "/" + pic[1] + "/" + pic[2] + "/Videos/" + pic[4][:-4] + ".mp4"
-                            cap = cv2.VideoCapture(mp4)
-                            if not cap.isOpened() and smask == 0:
+                            duration = catalog.duration(pic[4][:-4])
+                            if duration is None and smask == 0:
                                 text(ft,0,12,1,4,str(pic[4]))
                             elif smask == 0:
-                                fpsv = cap.get(cv2.CAP_PROP_FPS)
-                                frame_count = cap.get(cv2.CAP_PROP_FRAME_COUNT)
-                                duration = frame_count / fpsv if fpsv else 0
-                                cap.release()
                                 text(ft,0,12,1,4,str(pic[4][:-4]) + ".mp4 : " + str(int(duration)) + "s")
                         elif smask == 0:
                             text(ft,0,13,1,4,"0")
@@ -1632,4 +1738,3 @@ if __name__ == "__main__":
                         with open(config_file, 'w') as f:
                             for item in defaults:
                                 f.write("%s\n" % item)
-
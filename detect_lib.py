@@ -0,0 +1,1737 @@
+#!/usr/bin/env python3
+
+"""Helpers for detect_003.py that don't need the camera or the Hailo HAT."""
+
+import bisect
+import collections
+import concurrent.futures
+import glob
+import heapq
+import os
+import queue
+import shutil
+import sqlite3
+import struct
+import threading
+import time
+import cv2
+import numpy as np
+import pygame
+
+# bounded queue, when full the oldest item is dropped so the newest always wins
+class LatestQueue:
+    def __init__(self, maxsize=1):
+        self.maxsize = maxsize
+        self.items   = collections.deque()
+        self.dropped = 0
+        self.cond    = threading.Condition()
+
+    def __len__(self):
+        return len(self.items)
+
+    def put(self, item):
+        with self.cond:
+            if len(self.items) >= self.maxsize:
+                self.items.popleft()
+                self.dropped += 1
+            self.items.append(item)
+            self.cond.notify()
+
+    def get(self, timeout=None):
+        # returns None if nothing arrives within timeout
+        with self.cond:
+            if not self.items:
+                self.cond.wait(timeout)
+            if not self.items:
+                return None
+            return self.items.popleft()
+
+# frame count and busy time of one pipeline stage
+class StageStats:
+    def __init__(self):
+        self.count = 0
+        self.busy  = 0.0
+        self.start = time.monotonic()
+
+    def add(self, t):
+        self.count += 1
+        self.busy  += t
+
+    def fps(self):
+        el = time.monotonic() - self.start
+        return self.count / el if el > 0 else 0
+
+    def latency(self):
+        # mean ms per item
+        return 1000 * self.busy / self.count if self.count else 0
+
+# capture -> inference -> decision stages on their own threads, the ui stage
+# runs on the main thread (pygame) by calling run_ui() from the main loop
+class Pipeline:
+    def __init__(self, camera, infer, decide, stream='lores', scheduler=None, backend=None, prepare=None):
+        self.camera       = camera  # anything with capture_array(stream)
+        self.infer        = infer   # infer(frame) -> detections, with a backend infer(output) -> detections
+        self.decide       = decide  # decide(ts, frame, detections), called with Nones when idle
+        self.scheduler    = scheduler  # InferenceScheduler, or None to infer every frame
+        self.backend      = backend  # AsyncInference, or None to run infer(frame) in the inference stage
+        self.prepare      = prepare  # prepare(frame) -> model input, with a backend
+        self.stream       = stream
+        self.frames       = LatestQueue(1)
+        self.results      = LatestQueue(1)
+        self.ui_queue     = queue.Queue()  # ui calls change state (eg the catalog), so none are dropped
+        self.lock         = threading.RLock()  # held by decide(), take it to change recording state
+        self.paused       = False  # skip inference, eg when zoomed
+        self.running      = False
+        self.error        = None
+        self.latest_frame = None
+        self.stats        = {'capture': StageStats(), 'inference': StageStats(), 'decision': StageStats()}
+        self.threads      = []
+
+    def start(self):
+        self.running = True
+        for stage in (self._capture, self._inference, self._decision):
+            t = threading.Thread(target=self._guard, args=(stage,), daemon=True)
+            t.start()
+            self.threads.append(t)
+
+    def stop(self):
+        self.running = False
+        for t in self.threads:
+            t.join(1)
+        self.threads = []
+        if self.backend is not None:
+            self.backend.stop()
+
+    # queue a call for the ui stage
+    def ui(self, fn, *args):
+        self.ui_queue.put((fn, args))
+
+    # run queued ui calls, waits up to timeout for the first one
+    def run_ui(self, timeout=0):
+        if self.error is not None:
+            raise self.error
+        block = timeout > 0
+        while True:
+            try:
+                fn, args = self.ui_queue.get(block, timeout if block else None)
+            except queue.Empty:
+                return
+            fn(*args)
+            block = False
+
+    def _guard(self, stage):
+        try:
+            stage()
+        except Exception as e:
+            self._fail(e)
+
+    # keep the first error for run_ui to raise, and stop the stages
+    def _fail(self, e):
+        if self.error is None:
+            self.error = e
+        self.running = False
+
+    def _capture(self):
+        warned = 0
+        while self.running:
+            try:
+                frame = self.camera.capture_array(self.stream)
+            except Exception as e:
+                # eg a dropped frame, retry rather than stop the pipeline
+                if warned == 0:
+                    print("Capture failed", e)
+                    warned = 1
+                time.sleep(0.1)
+                continue
+            warned = 0
+            ts = time.monotonic()
+            self.latest_frame = frame
+            self.frames.put((ts, frame))
+            self.stats['capture'].add(time.monotonic() - ts)
+
+    def _inference(self):
+        while self.running:
+            item = self.frames.get(0.1)
+            if item is None or self.paused:
+                continue
+            ts, frame = item
+            if self.scheduler is not None and not self.scheduler.should_run(frame):
+                continue
+            if self.backend is not None:
+                # returns once the frame is in flight, results come back to _inferred
+                self.backend.submit(ts, frame, self._inferred_async, self.prepare)
+                continue
+            t0 = time.monotonic()
+            detections = self.infer(frame)
+            self._inferred(ts, frame, detections, time.monotonic() - t0, decoded=True)
+
+    def _inferred(self, ts, frame, output, t, decoded=False):
+        detections = output if decoded else self.infer(output)
+        self.stats['inference'].add(t)
+        if self.scheduler is not None:
+            self.scheduler.done(detections, t)
+        self.results.put((ts, frame, detections))
+
+    # backend callback on its worker thread, errors stop the pipeline as a stage's do
+    def _inferred_async(self, ts, frame, output, t):
+        try:
+            self._inferred(ts, frame, output, t)
+        except Exception as e:
+            self._fail(e)
+
+    def _decision(self):
+        while self.running:
+            item = self.results.get(0.1)
+            if item is None:
+                item = (None, None, None)
+            t0 = time.monotonic()
+            with self.lock:
+                self.decide(*item)
+            if item[0] is not None:
+                self.stats['decision'].add(time.monotonic() - t0)
+
+    def report(self):
+        s = self.stats
+        return ("capture %.1f fps, inference %.1f fps %.1f ms, decision %.1f ms, dropped frames %d results %d"
+                % (s['capture'].fps(), s['inference'].fps(), s['inference'].latency(),
+                   s['decision'].latency(), self.frames.dropped, self.results.dropped)
+                + ("" if self.scheduler is None else ", scheduler " + self.scheduler.report()))
+
+# motion against a running background of a small grey copy of the lores frame,
+# counted only in the enabled cells of the mask grid. Far cheaper than inference
+class MotionGate:
+    def __init__(self, size=(80, 80), threshold=15, min_fraction=0.002, alpha=0.05, grid=None):
+        self.size         = size          # (w, h)
+        self.threshold    = threshold     # grey level change that counts as motion
+        self.min_fraction = min_fraction  # of the enabled pixels, to count as motion
+        self.alpha        = alpha         # background learning rate per frame
+        self.background   = None
+        self.mask         = None  # enabled pixels, None for all
+        self.enabled      = size[0] * size[1]
+        self.level        = 0.0  # fraction of enabled pixels that moved in the last frame
+        if grid is not None:
+            self.set_mask(grid)
+
+    # grid of cells, [row][col] in frame layout, non zero where motion counts
+    def set_mask(self, grid):
+        grid = np.asarray(grid) != 0
+        if grid.all():
+            self.mask, self.enabled = None, self.size[0] * self.size[1]
+        else:
+            self.mask = cv2.resize(grid.astype(np.uint8), self.size, interpolation=cv2.INTER_NEAREST) != 0
+            self.enabled = int(self.mask.sum())
+
+    def update(self, frame):
+        # skip rows and columns down to about twice the size first, it's the bulk of the cost
+        step = max(1, min(frame.shape[0] // (2 * self.size[1]), frame.shape[1] // (2 * self.size[0])))
+        small = cv2.resize(frame[::step, ::step], self.size, interpolation=cv2.INTER_AREA)
+        grey  = cv2.cvtColor(small, cv2.COLOR_RGB2GRAY) if small.ndim == 3 else small
+        grey  = cv2.GaussianBlur(grey, (3, 3), 0)
+        if self.background is None:
+            self.background = grey.astype(np.float32)
+            return True
+        moved = cv2.absdiff(grey, self.background.astype(np.uint8)) > self.threshold
+        cv2.accumulateWeighted(grey, self.background, self.alpha)
+        if self.mask is not None:
+            moved &= self.mask
+        self.level = np.count_nonzero(moved) / max(self.enabled, 1)
+        return self.enabled > 0 and self.level >= self.min_fraction
+
+# picks the frames that go to inference. Every frame while recording, for motion_hold
+# seconds after motion, or for idle_after seconds after a detection, otherwise idle_fps.
+# With motion_hold as long as idle_after it slows down when idle, with a short one
+# it's a motion gate and idle_fps is a heartbeat
+class InferenceScheduler:
+    def __init__(self, idle_fps=2, idle_after=30, motion=None, motion_hold=None, clock=time.monotonic):
+        self.idle_fps    = idle_fps
+        self.idle_after  = idle_after
+        self.motion      = motion  # MotionGate, or None to wake only on detections
+        self.motion_hold = idle_after if motion_hold is None else motion_hold
+        self.clock       = clock
+        self.recording   = False  # set by the decision stage
+        self.mode        = "full"
+        self.seen        = clock()  # last detection
+        self.moved       = clock()  # last motion
+        self.last_run    = None
+        self.runs        = collections.deque(maxlen=50)  # times of recent inferences
+        self.latencies   = collections.deque(maxlen=200)  # ms
+        self.frames      = 0
+        self.skipped     = 0
+        self.gate_stats  = StageStats()
+
+    # True if this frame should go to inference
+    def should_run(self, frame):
+        now = self.clock()
+        self.frames += 1
+        if self.motion is not None:
+            t0 = time.perf_counter()
+            if self.motion.update(frame):
+                self.moved = now
+            self.gate_stats.add(time.perf_counter() - t0)
+        if self.recording or now - self.seen < self.idle_after or now - self.moved < self.motion_hold:
+            self.mode = "full"
+        else:
+            self.mode = "idle"
+        if self.mode == "idle" and self.last_run is not None and now - self.last_run < 1 / self.idle_fps:
+            self.skipped += 1
+            return False
+        self.last_run = now
+        self.runs.append(now)
+        return True
+
+    # after inference, with its detections and how long it took in seconds
+    def done(self, dets, t):
+        self.latencies.append(1000 * t)
+        if len(dets):
+            self.seen = self.clock()
+
+    # inferences per second, over the recent ones
+    def rate(self):
+        if len(self.runs) < 2:
+            return 0.0
+        return (len(self.runs) - 1) / max(self.runs[-1] - self.runs[0], 1e-6)
+
+    # mean and 95th percentile inference ms
+    def latency(self):
+        if not self.latencies:
+            return 0.0, 0.0
+        lat = np.array(self.latencies)
+        return float(lat.mean()), float(np.percentile(lat, 95))
+
+    # fraction of frames not sent to inference
+    def skip_fraction(self):
+        return self.skipped / self.frames if self.frames else 0.0
+
+    def report(self):
+        mean, p95 = self.latency()
+        return ("%s %.1f fps, %.1f ms (p95 %.1f), motion gate %.2f ms, skipped %.0f%%"
+                % (self.mode, self.rate(), mean, p95, self.gate_stats.latency(), 100 * self.skip_fraction()))
+
+# runs inference on a device with run_async(input) -> Future, eg picamera2's Hailo,
+# keeping up to window frames in flight so the device starts on the next frame while
+# Python decodes the last. on_done(ts, frame, output, t) is called in submit order on
+# the backend's thread, t is seconds from submit to result
+class AsyncInference:
+    def __init__(self, device, window=2):
+        self.device  = device
+        self.window  = window
+        self.slots   = threading.Semaphore(window)
+        self.pending = queue.Queue()
+        self.running = True
+        self.thread  = threading.Thread(target=self._run, daemon=True)
+        self.thread.start()
+
+    # frames still in flight are waited for but not passed on
+    def stop(self, timeout=1.0):
+        self.running = False
+        self.pending.put(None)
+        self.thread.join(timeout)
+
+    # prepare(frame) -> input is called once a slot is free, so it can reuse window buffers.
+    # Returns False if no slot came free within timeout
+    def submit(self, ts, frame, on_done, prepare=None, timeout=1.0):
+        if not self.slots.acquire(timeout=timeout):
+            return False
+        try:
+            data = frame if prepare is None else prepare(frame)
+            t0 = time.monotonic()
+            future = self.device.run_async(data)
+        except Exception:
+            self.slots.release()
+            raise
+        self.pending.put((ts, frame, future, t0, on_done))
+        return True
+
+    def in_flight(self):
+        return self.pending.qsize()
+
+    def _run(self):
+        while True:
+            item = self.pending.get()
+            if item is None:
+                return
+            ts, frame, future, t0, on_done = item
+            try:
+                output = future.result()
+            except Exception as e:
+                print("Inference failed", e)
+                self.slots.release()
+                continue
+            t = time.monotonic() - t0
+            # free the slot before decoding, so the device isn't kept waiting
+            self.slots.release()
+            if not self.running:
+                continue
+            try:
+                on_done(ts, frame, output, t)
+            except Exception as e:
+                print("Inference failed", e)
+
+# stand-in for Picamera2, returns a moving grey square at the camera frame rate
+# and records the encoder calls made on it
+class FakeCamera:
+    def __init__(self, size=(640, 640), fps=25, encoder_delay=0.0):
+        self.size  = size
+        self.fps   = fps
+        self.n     = 0
+        self.next  = time.monotonic()
+        self.delay = encoder_delay  # seconds to stop or start an encoder
+        self.calls = []  # (name, args) in order
+
+    def capture_array(self, name='lores'):
+        now = time.monotonic()
+        if now < self.next:
+            time.sleep(self.next - now)
+        self.next = max(self.next, now) + 1 / self.fps
+        w, h  = self.size
+        frame = np.zeros((h, w, 3), dtype=np.uint8)
+        x = (self.n * 8) % max(1, w - 64)
+        frame[h // 2 - 32:h // 2 + 32, x:x + 64] = 200
+        self.n += 1
+        return frame
+
+    def start_recording(self, encoder, output):
+        self.calls.append(('start_recording', (encoder, output)))
+
+    def start_encoder(self, encoder, output):
+        time.sleep(self.delay)
+        self.calls.append(('start_encoder', (encoder, output)))
+
+    def stop_encoder(self, encoders=None):
+        time.sleep(self.delay)
+        self.calls.append(('stop_encoder', (encoders,)))
+
+# detectors have the same interface as picamera2.devices.Hailo: get_input_shape(),
+# run(frame) and run_async(frame) -> Future, returning the HailoRT NMS output, per class
+# rows of y0, x0, y1, x1, score with the box as fractions of the frame. This gives
+# detectors with only a blocking run() a run_async(), frames are run one at a time in
+# the order given on the detector's own thread, like the Hailo
+class DetectorThread:
+    jobs = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def close(self):
+        pass
+
+    def run_async(self, frame):
+        future = concurrent.futures.Future()
+        if self.jobs is None:
+            self.jobs = queue.Queue()
+            threading.Thread(target=self._serve, daemon=True).start()
+        self.jobs.put((frame, future))
+        return future
+
+    def _serve(self):
+        while True:
+            frame, future = self.jobs.get()
+            try:
+                future.set_result(self.run(frame))
+            except Exception as e:
+                future.set_exception(e)
+
+# stand-in for picamera2.devices.Hailo, returns empty NMS output after latency seconds
+class FakeHailo(DetectorThread):
+    def __init__(self, input_shape=(640, 640, 3), latency=0.02, classes=80):
+        self.input_shape = input_shape
+        self.latency     = latency
+        self.classes     = classes
+
+    def get_input_shape(self):
+        return self.input_shape
+
+    def run(self, frame):
+        time.sleep(self.latency)
+        return [np.zeros((0, 5), dtype=np.float32) for c in range(self.classes)]
+
+# one row per detection, box is x0, y0, x1, y1 in pixels
+det_dtype = np.dtype([('class_id', np.int32), ('score', np.float32), ('box', np.int32, (4,))])
+no_detections = np.zeros(0, dtype=det_dtype)
+
+# bool array indexed by class id, True for the names in objects
+def allowed_classes(objects, class_names):
+    allowed = np.zeros(len(class_names), dtype=bool)
+    for c, name in enumerate(class_names):
+        if name in objects:
+            allowed[c] = True
+    return allowed
+
+def decode_detections(hailo_output, w, h, allowed=None, threshold=0.5):
+    """Decode the HailoRT-postprocess NMS output (per class, rows of y0, x0, y1, x1, score)
+    into a det_dtype array, filtered by threshold and allowed classes, highest score first."""
+    lengths = np.array([len(d) for d in hailo_output], dtype=np.intp)
+    if lengths.sum() == 0:
+        return no_detections
+    rows = np.concatenate([np.asarray(d, dtype=np.float32).reshape(-1, 5) for d in hailo_output if len(d)])
+    class_ids = np.repeat(np.arange(len(hailo_output), dtype=np.int32), lengths)
+    keep = rows[:, 4] >= threshold
+    if allowed is not None:
+        keep &= allowed[class_ids]
+    rows = rows[keep]
+    order = np.argsort(-rows[:, 4], kind='stable')
+    rows = rows[order]
+    dets = np.empty(len(rows), dtype=det_dtype)
+    dets['class_id'] = class_ids[keep][order]
+    dets['score']    = rows[:, 4]
+    dets['box']      = rows[:, [1, 0, 3, 2]] * np.array([w, h, w, h], dtype=np.float32)
+    return dets
+
+# value per class id, default unless named in thresholds, eg {"cat": 0.5}
+def class_thresholds(class_names, default, thresholds=None):
+    thresh = np.full(len(class_names), default, dtype=np.float32)
+    for c, name in enumerate(class_names):
+        if thresholds and name in thresholds:
+            thresh[c] = thresholds[name]
+    return thresh
+
+class TriggerRules:
+    """Which detections start and extend a recording, compiled once from objects so
+    each frame is a few array lookups by class id. Extend scores are lower than start
+    scores, so a recording isn't cut short by an object partly hidden for a moment."""
+
+    def __init__(self, objects, class_names, start=0.65, extend=None, thresholds=None, min_area=0, min_areas=None):
+        self.allowed      = allowed_classes(objects, class_names)
+        self.start_score  = class_thresholds(class_names, start, thresholds)
+        self.extend_score = np.minimum(self.start_score, start if extend is None else extend)
+        self.min_area     = class_thresholds(class_names, min_area, min_areas)
+        # lowest score any rule wants, for decode_detections
+        self.floor = float(self.extend_score[self.allowed].min()) if self.allowed.any() else start
+
+    # detections of wanted objects, big enough and above their extend score
+    def keep(self, dets):
+        if len(dets) == 0:
+            return dets
+        c = dets['class_id']
+        box = dets['box']
+        area = (box[:, 2] - box[:, 0]) * (box[:, 3] - box[:, 1])
+        return dets[self.allowed[c] & (dets['score'] >= self.extend_score[c]) & (area >= self.min_area[c])]
+
+    # detections above their start score, the ones drawn on stills and video.
+    # lower scoring ones only keep a recording going, and aren't shown
+    def shown(self, dets):
+        if len(dets) == 0:
+            return dets
+        return dets[dets['score'] >= self.start_score[dets['class_id']]]
+
+    # best of the tracks, best first, above its start score, or None
+    def start(self, tracks):
+        ok = np.flatnonzero(tracks['score'] >= self.start_score[tracks['class_id']])
+        return tracks[ok[0]] if len(ok) else None
+
+# IoU of every box in a against every box in b, x0, y0, x1, y1
+def box_iou(a, b):
+    a = a.astype(np.float32)[:, None, :]
+    b = b.astype(np.float32)[None, :, :]
+    iw = np.clip(np.minimum(a[..., 2], b[..., 2]) - np.maximum(a[..., 0], b[..., 0]), 0, None)
+    ih = np.clip(np.minimum(a[..., 3], b[..., 3]) - np.maximum(a[..., 1], b[..., 1]), 0, None)
+    inter = iw * ih
+    area_a = (a[..., 2] - a[..., 0]) * (a[..., 3] - a[..., 1])
+    area_b = (b[..., 2] - b[..., 0]) * (b[..., 3] - b[..., 1])
+    return inter / np.maximum(area_a + area_b - inter, 1)
+
+track_dtype = np.dtype(det_dtype.descr + [('track_id', np.int32), ('hits', np.int32)])
+no_tracks = np.zeros(0, dtype=track_dtype)
+
+class Tracker:
+    """Follows detections from frame to frame by IoU, or by centroid distance for
+    small fast objects, so a trigger needs an object seen in confirm of the last
+    window frames rather than one high score."""
+
+    def __init__(self, confirm=3, window=5, iou=0.3, gate=0.5):
+        self.confirm = confirm
+        self.window  = window
+        self.iou     = iou
+        self.gate    = gate  # centroid distance, as a fraction of the track's larger side
+        self.next_id = 1
+        self.reset()
+
+    def reset(self):
+        self.tracks    = no_tracks.copy()
+        self.hist      = np.zeros((0, self.window), dtype=bool)  # seen in the last frames, newest first
+        self.confirmed = np.zeros(0, dtype=bool)
+
+    def update(self, dets):
+        """Add a frame's detections, returns the confirmed tracks seen in it, best first."""
+        ti, di = self._match(dets)
+        hist = np.zeros_like(self.hist)
+        hist[:, 1:] = self.hist[:, :-1]
+        hist[ti, 0] = True
+        tracks = self.tracks
+        tracks['box'][ti]   = dets['box'][di]
+        tracks['score'][ti] = dets['score'][di]
+
+        # new tracks for unmatched detections
+        new = np.ones(len(dets), dtype=bool)
+        new[di] = False
+        born = np.zeros(int(new.sum()), dtype=track_dtype)
+        for name in det_dtype.names:
+            born[name] = dets[name][new]
+        born['track_id'] = np.arange(self.next_id, self.next_id + len(born))
+        self.next_id += len(born)
+        born_hist = np.zeros((len(born), self.window), dtype=bool)
+        born_hist[:, 0] = True
+
+        # drop tracks not seen for a whole window
+        keep = hist.any(axis=1)
+        self.tracks    = np.concatenate([tracks[keep], born])
+        self.hist      = np.concatenate([hist[keep], born_hist])
+        self.tracks['hits'] = self.hist.sum(axis=1)
+        self.confirmed = np.concatenate([self.confirmed[keep], np.zeros(len(born), dtype=bool)])
+        self.confirmed |= self.tracks['hits'] >= self.confirm
+
+        seen = self.tracks[self.confirmed & self.hist[:, 0]]
+        return seen[np.argsort(-seen['score'], kind='stable')]
+
+    # greedy one to one matching of tracks to detections of the same class, best first
+    def _match(self, dets):
+        if len(self.tracks) == 0 or len(dets) == 0:
+            return np.zeros(0, dtype=np.intp), np.zeros(0, dtype=np.intp)
+        tb, db = self.tracks['box'], dets['box']
+        iou = box_iou(tb, db)
+        tc = (tb[:, :2] + tb[:, 2:]) / 2
+        dc = (db[:, :2] + db[:, 2:]) / 2
+        size = np.maximum(np.maximum(tb[:, 2] - tb[:, 0], tb[:, 3] - tb[:, 1]), 1)
+        dist = np.hypot(*(tc[:, None, :] - dc[None, :, :]).transpose(2, 0, 1)) / size[:, None]
+        valid = (self.tracks['class_id'][:, None] == dets['class_id'][None, :]) & ((iou >= self.iou) | (dist <= self.gate))
+        rows, cols = np.nonzero(valid)
+        order = np.argsort(-(iou[rows, cols] - dist[rows, cols]), kind='stable')
+        ti, di = [], []
+        used_t, used_d = set(), set()
+        for r, c in zip(rows[order], cols[order]):
+            if r not in used_t and c not in used_d:
+                used_t.add(r)
+                used_d.add(c)
+                ti.append(r)
+                di.append(c)
+        return np.array(ti, dtype=np.intp), np.array(di, dtype=np.intp)
+
+# detection streams, one row per detection tagged with its frame number, for replay.
+# each frame starts with a header row, class_id -1 and score the number of detections,
+# so frames with no detections and runs appended to the same file keep their boundaries
+stream_dtype = np.dtype([('frame', np.int32)] + det_dtype.descr)
+
+def write_stream(f, frame_no, dets):
+    rows = np.zeros(len(dets) + 1, dtype=stream_dtype)
+    rows['frame'] = frame_no
+    rows[0]['class_id'] = -1
+    rows[0]['score'] = len(dets)
+    for name in det_dtype.names:
+        rows[name][1:] = dets[name]
+    rows.tofile(f)
+
+# list of det_dtype arrays, one per frame, from a file written by write_stream.
+# files without header rows split on frame numbers, which restart with each run
+def read_stream(path):
+    rows = np.fromfile(path, dtype=stream_dtype)
+    if len(rows) == 0:
+        return []
+    header = rows['class_id'] == -1
+    if header.any():
+        starts = np.nonzero(header)[0]
+        parts = [rows[a + 1:b] for a, b in zip(starts, np.append(starts[1:], len(rows)))]
+    else:
+        frames = rows['frame'].astype(np.int64)
+        restarts = np.nonzero(np.diff(frames) < 0)[0]
+        run = np.zeros(len(frames), dtype=np.intp)
+        run[restarts + 1] = 1
+        offsets = np.concatenate(([0], np.cumsum(frames[restarts] + 1)))
+        frames += offsets[np.cumsum(run)]
+        parts = np.split(rows, np.searchsorted(frames, np.arange(1, frames.max() + 1)))
+    out = []
+    for part in parts:
+        dets = np.empty(len(part), dtype=det_dtype)
+        for name in det_dtype.names:
+            dets[name] = part[name]
+        out.append(dets)
+    return out
+
+# HailoRT style NMS output from class ids, scores and x0, y0, x1, y1 boxes as fractions
+def nms_output(class_ids, scores, boxes, classes=80):
+    rows = np.empty((len(class_ids), 5), dtype=np.float32)
+    rows[:, :4] = np.asarray(boxes, dtype=np.float32).reshape(-1, 4)[:, [1, 0, 3, 2]]
+    rows[:, 4] = scores
+    return [rows[class_ids == c] for c in range(classes)]
+
+class CpuDetector(DetectorThread):
+    """A YOLOv8 ONNX export run on the CPU, with onnxruntime if it's installed, else
+    OpenCV DNN. Far slower than the Hailo, for testing or when the HAT has failed."""
+
+    def __init__(self, model, classes=80, threshold=0.25, iou=0.45, input_size=(640, 640)):
+        self.classes   = classes
+        self.threshold = threshold
+        self.iou       = iou
+        self.size      = input_size  # (w, h)
+        self.session   = None
+        self.net       = None
+        try:
+            import onnxruntime
+        except ImportError:
+            self.net = cv2.dnn.readNetFromONNX(model)
+        else:
+            self.session = onnxruntime.InferenceSession(model, providers=['CPUExecutionProvider'])
+            self.input_name = self.session.get_inputs()[0].name
+            shape = self.session.get_inputs()[0].shape
+            if isinstance(shape[2], int) and isinstance(shape[3], int):
+                self.size = (shape[3], shape[2])
+
+    def get_input_shape(self):
+        return (self.size[1], self.size[0], 3)
+
+    def run(self, frame):
+        # lores frames are BGR in memory, the model wants RGB
+        blob = cv2.dnn.blobFromImage(frame, 1 / 255, self.size, swapRB=True)
+        if self.session is not None:
+            out = self.session.run(None, {self.input_name: blob})[0]
+        else:
+            self.net.setInput(blob)
+            out = self.net.forward()
+        return self.decode(out)
+
+    # (1, 4 + classes, anchors) of cx, cy, w, h and class scores, to NMS output
+    def decode(self, out):
+        pred = out[0].T
+        scores = pred[:, 4:]
+        class_ids = scores.argmax(axis=1).astype(np.int32)
+        conf = scores[np.arange(len(pred)), class_ids]
+        keep = conf >= self.threshold
+        pred, class_ids, conf = pred[keep], class_ids[keep], conf[keep]
+        if len(pred) == 0:
+            return nms_output(class_ids, conf, np.zeros((0, 4)), self.classes)
+        xywh = np.empty((len(pred), 4), dtype=np.float32)
+        xywh[:, :2] = pred[:, :2] - pred[:, 2:4] / 2
+        xywh[:, 2:] = pred[:, 2:4]
+        idx = np.asarray(cv2.dnn.NMSBoxesBatched(xywh.tolist(), conf.tolist(), class_ids.tolist(),
+                                                 self.threshold, self.iou), dtype=np.intp).reshape(-1)
+        w, h = self.size
+        boxes = np.column_stack([xywh[idx, 0], xywh[idx, 1], xywh[idx, 0] + xywh[idx, 2], xywh[idx, 1] + xywh[idx, 3]])
+        boxes = np.clip(boxes / np.array([w, h, w, h], dtype=np.float32), 0, 1)
+        return nms_output(class_ids[idx], conf[idx], boxes, self.classes)
+
+class ReplayDetector(DetectorThread):
+    """Plays back the detections of a stream written with log_stream = 1, a frame per
+    run(), looping at the end. size is the video size the boxes were recorded in."""
+
+    def __init__(self, path, size, input_shape=(640, 640, 3), classes=80):
+        self.frames      = read_stream(path)
+        self.scale       = np.array([size[0], size[1], size[0], size[1]], dtype=np.float32)
+        self.input_shape = input_shape
+        self.classes     = classes
+        self.n           = 0
+
+    def get_input_shape(self):
+        return self.input_shape
+
+    def run(self, frame):
+        dets = self.frames[self.n % len(self.frames)] if self.frames else no_detections
+        self.n += 1
+        return nms_output(dets['class_id'], dets['score'], dets['box'] / self.scale, self.classes)
+
+# applies a 0/1 mask to frames like frame * mask, but into a reused uint8 buffer
+class FrameMasker:
+    def __init__(self, mask=None, channels=3, buffers=1):
+        self.channels = channels
+        self.mask     = None
+        self.bufs     = [None] * buffers  # one per frame that may be in flight at once
+        self.next     = 0
+        self.active   = False
+        if mask is not None:
+            self.set(mask)
+
+    def set(self, mask):
+        # mask in the frame's layout, (h, w) or (h, w, channels), 0 = hidden
+        m = np.asarray(mask) != 0
+        if m.ndim == 3:
+            m = m.any(axis=2)
+        # full frame shape, np.multiply is several times faster without broadcasting
+        m = np.ascontiguousarray(np.broadcast_to(m[:, :, None], m.shape + (self.channels,)), dtype=np.uint8)
+        self.active = not m.all()
+        self.mask   = m
+
+    def apply(self, frame):
+        if not self.active:
+            return frame
+        buf = self.bufs[self.next]
+        if buf is None or buf.shape != frame.shape or buf.dtype != frame.dtype:
+            buf = self.bufs[self.next] = np.empty_like(frame)
+        self.next = (self.next + 1) % len(self.bufs)
+        np.multiply(frame, self.mask, out=buf)
+        return buf
+
+# mask grid compiled for detection filtering, instead of blanking pixels before inference.
+# grid[row][col] is True for enabled cells, boxes are looked up against it in O(1)
+class TileMask:
+    def __init__(self, grid=None, min_overlap=0):
+        self.min_overlap = min_overlap  # 0 = accept on box centre, else fraction of box cells enabled
+        self.grid = None
+        self.sat  = None
+        self.all  = True
+        if grid is not None:
+            self.set(grid)
+
+    def set(self, grid):
+        grid = np.asarray(grid) != 0
+        # summed area table, padded so a box's enabled cells are 4 lookups
+        sat = np.zeros((grid.shape[0] + 1, grid.shape[1] + 1), dtype=np.int32)
+        sat[1:, 1:] = grid.cumsum(0).cumsum(1)
+        self.grid, self.sat, self.all = grid, sat, bool(grid.all())
+
+    def accept(self, dets, w, h):
+        # dets with boxes in a w x h frame, returns those in enabled cells
+        if self.all or len(dets) == 0:
+            return dets
+        grid, sat = self.grid, self.sat
+        gh, gw = grid.shape
+        box = dets['box'].astype(np.float32) * np.array([gw / w, gh / h, gw / w, gh / h], dtype=np.float32)
+        if self.min_overlap <= 0:
+            cx = np.clip(((box[:, 0] + box[:, 2]) / 2).astype(np.intp), 0, gw - 1)
+            cy = np.clip(((box[:, 1] + box[:, 3]) / 2).astype(np.intp), 0, gh - 1)
+            keep = grid[cy, cx]
+        else:
+            c0 = np.clip(np.floor(box[:, 0]).astype(np.intp), 0, gw - 1)
+            r0 = np.clip(np.floor(box[:, 1]).astype(np.intp), 0, gh - 1)
+            c1 = np.clip(np.ceil(box[:, 2]).astype(np.intp), c0 + 1, gw)
+            r1 = np.clip(np.ceil(box[:, 3]).astype(np.intp), r0 + 1, gh)
+            enabled = sat[r1, c1] - sat[r0, c1] - sat[r1, c0] + sat[r0, c0]
+            keep = enabled >= self.min_overlap * (r1 - r0) * (c1 - c0)
+        return dets[keep]
+
+def load_mask(path, size=None):
+    """Read a mask bmp (white = detect) as a 0/1 uint8 3 channel array in detect_003's
+    mask[x][y] layout. With size (w, h) it's resized to the model and cached beside the bmp."""
+    cache = None
+    if size is not None:
+        cache = "%s_%dx%d.npy" % (os.path.splitext(path)[0], size[0], size[1])
+        if os.path.exists(cache) and os.path.getmtime(cache) >= os.path.getmtime(path):
+            return np.load(cache)
+    img = cv2.imread(path)
+    if img is None:
+        raise ValueError("Can't read mask " + path)
+    if img.shape[0] != img.shape[1]:
+        raise ValueError("Mask %s must be square, it is %dx%d" % (path, img.shape[1], img.shape[0]))
+    # any channel over 128 = 1, then rot90 + flipud (a transpose)
+    mask = (img > 128).any(axis=2).T.astype(np.uint8)
+    mask = np.repeat(mask[:, :, None], 3, axis=2)
+    if size is not None:
+        mask = cv2.resize(mask, size, interpolation=cv2.INTER_AREA)
+        try:
+            np.save(cache, mask)
+        except OSError as e:
+            print("Can't cache mask", e)
+    return mask
+
+# the gridmask x gridmask mask being edited, grid[x][y] True = detect.
+# the model resolution mask is derived from it and Mask2.bmp is written on a background thread
+class MaskGrid:
+    def __init__(self, grid):
+        self.grid   = np.ascontiguousarray(np.asarray(grid) != 0)
+        self.saves  = LatestQueue(1)
+        self.writer = None
+
+    # cell under point x, y of a w x h view
+    def cell(self, x, y, w, h):
+        gx, gy = self.grid.shape
+        return min(max(int(x * gx / w), 0), gx - 1), min(max(int(y * gy / h), 0), gy - 1)
+
+    def fill(self, value):
+        self.grid[:, :] = bool(value)
+
+    def toggle(self, cx, cy):
+        self.grid[cx, cy] = not self.grid[cx, cy]
+
+    def expand(self, size):
+        # 0/1 uint8 3 channel mask, size as cv2 dsize
+        m = cv2.resize(self.grid.astype(np.uint8), size, interpolation=cv2.INTER_NEAREST)
+        return np.repeat(m[:, :, None], 3, axis=2)
+
+    def save(self, path):
+        self.saves.put((path, self.grid.copy()))
+        if self.writer is None:
+            self.writer = threading.Thread(target=self._write, daemon=True)
+            self.writer.start()
+
+    def _write(self):
+        while True:
+            path, grid = self.saves.get()
+            cv2.imwrite(path, np.repeat(grid[:, :, None], 3, axis=2).astype(np.uint8))
+
+# cached fonts and rendered labels for the review window, with the changed
+# areas collected and sent to the display once per main loop
+class UIRenderer:
+    def __init__(self, surface, font_path='/usr/share/fonts/truetype/freefont/FreeSerif.ttf', max_labels=512):
+        self.surface    = surface
+        self.font_path  = font_path if os.path.exists(font_path) else None
+        self.max_labels = max_labels
+        self.fonts      = {}
+        self.labels     = collections.OrderedDict()
+        self.dirty      = []
+
+    def font(self, size):
+        f = self.fonts.get(size)
+        if f is None:
+            f = self.fonts[size] = pygame.font.Font(self.font_path, size)
+        return f
+
+    def label(self, msg, color, size):
+        key = (msg, tuple(color), size)
+        surf = self.labels.get(key)
+        if surf is None:
+            surf = self.labels[key] = self.font(size).render(msg, False, color)
+            if len(self.labels) > self.max_labels:
+                self.labels.popitem(last=False)
+        else:
+            self.labels.move_to_end(key)
+        return surf
+
+    def update(self, rect):
+        self.dirty.append(pygame.Rect(rect))
+
+    def flush(self):
+        if self.dirty:
+            pygame.display.update(self.dirty)
+            self.dirty = []
+
+# focus view, a size crop of the middle of the main stream shown 1:1. The crop is sliced
+# from the frame (or the MappedArray) before any conversion and written straight into a
+# reused surface, at most fps times a second. sharpness is the crop's Laplacian variance
+class ZoomView:
+    def __init__(self, size, fps=10):
+        self.size      = size  # (w, h)
+        self.interval  = 1 / fps
+        self.surface   = pygame.Surface(size)
+        self.last      = 0.0
+        self.sharpness = 0.0
+
+    def due(self):
+        return time.monotonic() - self.last >= self.interval
+
+    # top left of the crop, moved by xo rows and yo columns from the middle
+    def origin(self, shape, xo, yo):
+        w, h = self.size
+        r0 = min(max(shape[0] // 2 - h // 2 - xo, 0), shape[0] - h)
+        c0 = min(max(shape[1] // 2 - w // 2 - yo, 0), shape[1] - w)
+        return r0, c0
+
+    # frame is (h, w, 3 or 4) BGR(X) in memory, as picamera2 RGB888 / XRGB8888
+    def update(self, frame, xo=0, yo=0):
+        w, h = self.size
+        r0, c0 = self.origin(frame.shape, xo, yo)
+        crop = frame[r0:r0 + h, c0:c0 + w]
+        # surfarray is [x][y], so the crop transposed, with the channels reversed to RGB
+        pygame.surfarray.blit_array(self.surface, crop[:, :, 2::-1].transpose(1, 0, 2))
+        grey = cv2.cvtColor(crop, cv2.COLOR_BGRA2GRAY if crop.shape[2] == 4 else cv2.COLOR_BGR2GRAY)
+        self.sharpness = float(cv2.Laplacian(grey, cv2.CV_32F).var())
+        self.last = time.monotonic()
+        return self.surface
+
+# review pane images (trigger stills, the mask being edited) from lores frames. The masked
+# frame, the scaled frame and the surface are allocated once, and the scaled buffer's
+# surfarray view (transposed, channels reversed to RGB) is made once, so nothing is allocated per update
+class ReviewRenderer:
+    def __init__(self, size):
+        w, h = size
+        self.size    = size  # (w, h)
+        self.surface = pygame.Surface(size)
+        self.scaled  = np.empty((h, w, 3), dtype=np.uint8)
+        self.view    = self.scaled[:, :, ::-1].transpose(1, 0, 2)
+        self.masked  = None
+        self.frame   = None  # last frame rendered
+
+    # frame is (h, w, 3) BGR in memory, as picamera2 RGB888. mask is 0/1 uint8 in the frame's layout.
+    # Without a frame (eg before the first one arrives) the last one is used, or black if there's none
+    def render(self, frame, mask=None):
+        if not isinstance(frame, np.ndarray):
+            frame = self.frame
+            if frame is None:
+                self.surface.fill((0, 0, 0))
+                return self.surface
+        self.frame = frame
+        if mask is not None:
+            if self.masked is None or self.masked.shape != frame.shape:
+                self.masked = np.empty_like(frame)
+            np.multiply(frame, mask, out=self.masked)
+            frame = self.masked
+        # nearest, as pygame.transform.scale
+        cv2.resize(frame, self.size, dst=self.scaled, interpolation=cv2.INTER_NEAREST)
+        pygame.surfarray.blit_array(self.surface, self.view)
+        return self.surface
+
+# video timestamp on a black box, rendered into a small patch in the frame's layout only when
+# the second changes, then copied into each frame with one slice assignment. The box covers
+# width pixels from origin (the text's bottom left) and the text's full height
+class TimestampOverlay:
+    def __init__(self, origin, font=cv2.FONT_HERSHEY_SIMPLEX, scale=1, colour=(255, 255, 255), thickness=2, width=365, fmt="%Y/%m/%d %T"):
+        self.origin    = origin
+        self.font      = font
+        self.scale     = scale
+        self.colour    = colour
+        self.thickness = thickness
+        self.width     = width
+        self.fmt       = fmt
+        self.shape     = None
+        self.patch     = None
+        self.second    = None
+
+    # patch and the slices it's copied through, clipped to a frame of shape
+    def layout(self, shape, dtype=np.uint8):
+        x, y = self.origin
+        (tw, th), base = cv2.getTextSize(time.strftime(self.fmt), self.font, self.scale, self.thickness)
+        top, left = y - max(th, 20), x
+        bottom, right = y + base + 1, x + max(tw, self.width) + 1
+        self.patch = np.zeros((bottom - top, right - left) + tuple(shape[2:]), dtype=dtype)
+        self.text  = (x - left, y - top)
+        r0, r1 = max(top, 0), min(bottom, shape[0])
+        c0, c1 = max(left, 0), min(right, shape[1])
+        self.src   = self.patch[r0 - top:r1 - top, c0 - left:c1 - left]
+        self.dst   = (slice(r0, r1), slice(c0, c1))
+        self.shape  = shape
+        self.second = None
+
+    def draw(self, frame, now=None):
+        second = int(time.time() if now is None else now)
+        if frame.shape != self.shape:
+            self.layout(frame.shape, frame.dtype)
+        if second != self.second:
+            self.patch[:] = 0
+            cv2.putText(self.patch, time.strftime(self.fmt, time.localtime(second)), self.text,
+                        self.font, self.scale, self.colour, self.thickness)
+            self.second = second
+        frame[self.dst] = self.src
+
+# detection boxes and labels on the video. publish() swaps in the latest detections and their
+# capture time as one tuple, so the camera thread reads a consistent snapshot without a lock.
+# Boxes are scaled to the frame once per snapshot, labels are cached patches copied in through
+# their text pixels, and nothing is drawn once the detections are more than stale frames old
+class BoxOverlay:
+    def __init__(self, class_names, size, fps=25, stale=5, colour=(0, 255, 0, 0), thickness=4, font=cv2.FONT_HERSHEY_SIMPLEX,
+                 scale=2, text_thickness=3, max_labels=256, clock=time.monotonic):
+        self.class_names    = class_names
+        self.size           = size  # (w, h) the boxes are in
+        self.max_age        = stale / fps  # seconds since capture
+        self.colour         = colour
+        self.thickness      = thickness
+        self.font           = font
+        self.scale          = scale
+        self.text_thickness = text_thickness
+        self.max_labels     = max_labels
+        self.clock          = clock
+        self.labels         = collections.OrderedDict()
+        self.latest         = None
+        self.scaled         = (None, None, [])  # snapshot, frame shape, [(x0, y0, x1, y1, label)]
+
+    # called with each frame's detections (det_dtype, not changed afterwards) and its capture time
+    def publish(self, ts, dets):
+        self.latest = (ts, dets)
+
+    def label(self, msg, channels):
+        key = (msg, channels)
+        item = self.labels.get(key)
+        if item is None:
+            (tw, th), base = cv2.getTextSize(msg, self.font, self.scale, self.text_thickness)
+            pad = self.text_thickness
+            patch = np.zeros((th + base + 2 * pad, tw + 2 * pad, channels), dtype=np.uint8)
+            cv2.putText(patch, msg, (pad, th + pad), self.font, self.scale, self.colour, self.text_thickness, cv2.LINE_AA)
+            item = self.labels[key] = (patch, patch.any(axis=2).astype(np.uint8), pad, th + pad)
+            if len(self.labels) > self.max_labels:
+                self.labels.popitem(last=False)
+        else:
+            self.labels.move_to_end(key)
+        return item
+
+    def boxes(self, snap, shape):
+        if self.scaled[0] is not snap or self.scaled[1] != shape:
+            dets = snap[1]
+            sx, sy = shape[1] / self.size[0], shape[0] / self.size[1]
+            box = (dets['box'] * np.array([sx, sy, sx, sy], dtype=np.float32)).astype(np.intp)
+            items = [(int(b[0]), int(b[1]), int(b[2]), int(b[3]), "%s %%%d" % (self.class_names[c], int(s * 100)))
+                     for b, c, s in zip(box, dets['class_id'], dets['score'])]
+            self.scaled = (snap, shape, items)
+        return self.scaled[2]
+
+    def draw(self, frame):
+        snap = self.latest
+        if snap is None or len(snap[1]) == 0 or self.clock() - snap[0] > self.max_age:
+            return False
+        fh, fw = frame.shape[:2]
+        for x0, y0, x1, y1, msg in self.boxes(snap, frame.shape):
+            cv2.rectangle(frame, (x0, y0), (x1, y1), self.colour, self.thickness)
+            patch, mask, ox, oy = self.label(msg, frame.shape[2])
+            # text baseline at x0 + 5, y0 + 45, clipped to the frame
+            top, left = y0 + 45 - oy, x0 + 5 - ox
+            r0, r1 = max(top, 0), min(top + patch.shape[0], fh)
+            c0, c1 = max(left, 0), min(left + patch.shape[1], fw)
+            if r0 < r1 and c0 < c1:
+                src = (slice(r0 - top, r1 - top), slice(c0 - left, c1 - left))
+                cv2.copyTo(patch[src], mask[src], frame[r0:r1, c0:c1])
+        return True
+
+# outline of the masked cells on the video. set() takes the grid ([row][col] in frame layout,
+# non zero = detect) and swaps in a new outline, the edge pixels are listed once per frame size.
+# XRGB frames are written as one uint32 per pixel, several times faster than per channel
+class MaskOutline:
+    def __init__(self, colour=(255, 255, 255, 0)):
+        self.colour  = colour
+        self.pixel   = np.array(colour, dtype=np.uint8).view(np.uint32)[0]
+        self.grid    = None
+        self.outline = (None, None, None, None)  # grid, frame shape, (rows, cols), flat indices
+
+    def set(self, grid):
+        self.grid = np.asarray(grid) != 0
+
+    def draw(self, frame):
+        grid = self.grid
+        if grid is None or grid.all():
+            return False
+        if self.outline[0] is not grid or self.outline[1] != frame.shape:
+            m = cv2.resize(grid.astype(np.uint8), (frame.shape[1], frame.shape[0]), interpolation=cv2.INTER_NEAREST)
+            edge = np.zeros(m.shape, dtype=bool)
+            edge[:, 1:] |= m[:, 1:] != m[:, :-1]
+            edge[1:, :] |= m[1:, :] != m[:-1, :]
+            self.outline = (grid, frame.shape, np.nonzero(edge), np.flatnonzero(edge))
+        if frame.shape[2] == 4 and frame.dtype == np.uint8 and frame.flags.c_contiguous:
+            frame.view(np.uint32).reshape(-1)[self.outline[3]] = self.pixel
+        else:
+            frame[self.outline[2]] = self.colour[:frame.shape[2]]
+        return True
+
+# camera pre_callback overlays, drawn in order onto the main stream frame, later ones on top
+class OverlayChain:
+    def __init__(self, *overlays):
+        self.overlays = list(overlays)
+
+    def add(self, overlay):
+        self.overlays.append(overlay)
+
+    def draw(self, frame):
+        for overlay in self.overlays:
+            overlay.draw(frame)
+
+# free space on the tmpfs clips are recorded to, sampled on a background thread.
+# bytes written since the last sample are taken off so headroom is known between samples
+class StorageMonitor:
+    def __init__(self, path="/run/shm/", limit=150000000, interval=2.0):
+        self.path     = path
+        self.limit    = limit     # bytes
+        self.interval = interval  # seconds between statvfs samples
+        self.free     = 0
+        self.pending  = 0
+        self.lock     = threading.Lock()
+        self.thread   = None
+        self.sample()
+
+    def start(self):
+        self.thread = threading.Thread(target=self._run, daemon=True)
+        self.thread.start()
+
+    def _run(self):
+        while True:
+            time.sleep(self.interval)
+            self.sample()
+
+    def sample(self):
+        st = os.statvfs(self.path)
+        with self.lock:
+            self.free    = st.f_bavail * st.f_frsize
+            self.pending = 0
+
+    # called by the recorder with each chunk it writes
+    def written(self, n):
+        with self.lock:
+            self.pending += n
+
+    def free_bytes(self):
+        return self.free - self.pending
+
+    def has_headroom(self):
+        return self.free_bytes() > self.limit
+
+# moves finished clips from ram to the SD card on a background thread.
+# large buffer copies, fsync'd in batches before the ram copy is removed,
+# on_done(path) is called with each clip's new path
+class StorageMover:
+    def __init__(self, dest, on_done=None, bufsize=4 * 1024 * 1024, batch=4):
+        self.dest    = dest
+        self.on_done = on_done
+        self.bufsize = bufsize
+        self.batch   = batch  # fsync after this many clips, or when the queue empties
+        self.jobs    = queue.Queue()
+        self.thread  = None
+
+    def start(self):
+        self.thread = threading.Thread(target=self._run, daemon=True)
+        self.thread.start()
+
+    def move(self, src):
+        self.jobs.put(src)
+
+    # block until queued clips are moved
+    def wait(self):
+        self.jobs.join()
+
+    def _run(self):
+        copied = []
+        while True:
+            src = self.jobs.get()
+            try:
+                dst, moved = self._target(src)
+                if moved:
+                    # already there from an interrupted move, finish it
+                    os.remove(src)
+                    if self.on_done is not None:
+                        self.on_done(dst)
+                else:
+                    part = dst + ".part"
+                    with open(src, 'rb') as fsrc, open(part, 'wb') as fdst:
+                        shutil.copyfileobj(fsrc, fdst, self.bufsize)
+                    copied.append((src, part, dst))
+            except OSError as e:
+                print("Move failed", src, e)
+            if copied and (len(copied) >= self.batch or self.jobs.unfinished_tasks <= 1):
+                self._sync(copied)
+                copied = []
+            self.jobs.task_done()
+
+    # where src goes, and True if it's there already with the same size
+    def _target(self, src):
+        dst = os.path.join(self.dest, os.path.basename(src))
+        return dst, os.path.exists(dst) and os.path.getsize(dst) == os.path.getsize(src)
+
+    # a different file of the same name is kept as name_1, name_2 ..., the new clip
+    # takes the name so it stays paired with the still and metadata of its capture
+    def _aside(self, dst):
+        name, ext = os.path.splitext(dst)
+        n = 1
+        while os.path.exists("%s_%d%s" % (name, n, ext)):
+            n += 1
+        aside = "%s_%d%s" % (name, n, ext)
+        os.rename(dst, aside)
+        return aside
+
+    def _sync(self, copied):
+        for src, part, dst in copied:
+            try:
+                fd = os.open(part, os.O_RDONLY)
+                try:
+                    os.fsync(fd)
+                finally:
+                    os.close(fd)
+                aside = self._aside(dst) if os.path.exists(dst) else None
+                os.rename(part, dst)
+                os.remove(src)
+            except OSError as e:
+                print("Move failed", src, e)
+                continue
+            if self.on_done is not None:
+                if aside is not None:
+                    self.on_done(aside)
+                self.on_done(dst)
+
+class Recorder:
+    """Recording state, idle -> recording -> post-roll -> idle. Recording while triggers
+    keep coming, post-roll once there's been none for quiet seconds, then idle post_roll
+    seconds after the last one. A trigger in post-roll extends the recording, and one
+    longer than max_length rolls over to a new clip.
+
+    update() returns the event for a transition, "start", "post-roll", "extend",
+    "rollover" or "stop", or None."""
+
+    def __init__(self, post_roll=15, max_length=600, quiet=1.0, clock=time.monotonic):
+        self.post_roll  = post_roll
+        self.max_length = max_length
+        self.quiet      = quiet
+        self.clock      = clock
+        self.state      = "idle"
+        self.started    = None  # start of the recording
+        self.clip_start = None  # start of the current clip
+        self.last       = None  # last trigger
+
+    def update(self, triggered, headroom=True):
+        now = self.clock()
+        if self.state == "idle":
+            if triggered and headroom:
+                self.state = "recording"
+                self.started = self.clip_start = self.last = now
+                return "start"
+            return None
+        if not headroom:
+            self.state = "idle"
+            return "stop"
+        if triggered:
+            self.last = now
+        if now - self.clip_start >= self.max_length:
+            self.clip_start = now
+            return "rollover"
+        if self.state == "recording":
+            if not triggered and now - self.last >= self.quiet:
+                self.state = "post-roll"
+                return "post-roll"
+        elif triggered:
+            self.state = "recording"
+            return "extend"
+        elif now - self.last > self.post_roll:
+            self.state = "idle"
+            return "stop"
+        return None
+
+# the video encoder and pre-detection buffer on the running camera. A bitrate change swaps
+# in a new encoder and buffer with stop_encoder / start_encoder, leaving the camera, its
+# preview and the lores stream running, and a buffer length change is made live. A swap
+# asked for while a clip is open waits for the clip to close. Call it from one thread,
+# and tick() once per camera frame so the frames lost in a swap are counted
+class EncoderManager:
+    def __init__(self, camera, make_encoder, make_output, bitrate, buffer_ms, clock=time.monotonic):
+        self.camera       = camera  # Picamera2, or anything with start_recording, start_encoder and stop_encoder
+        self.make_encoder = make_encoder  # make_encoder(bitrate), eg an H264Encoder
+        self.make_output  = make_output   # make_output(buffer_ms), eg a CircularOutput2
+        self.bitrate      = bitrate
+        self.buffer_ms    = buffer_ms
+        self.encoder      = make_encoder(bitrate)
+        self.output       = make_output(buffer_ms)
+        self.clock        = clock
+        self.frames       = 0
+        self.clip_open    = False
+        self.pending      = False  # bitrate swap waiting for the clip to close
+        self.gap          = None   # (frames, seconds) lost in the last swap
+
+    def tick(self):
+        self.frames += 1
+
+    # starts the camera too
+    def start_recording(self):
+        self.camera.start_recording(self.encoder, self.output)
+
+    def open_output(self, output):
+        self.output.open_output(output)
+        self.clip_open = True
+
+    def close_output(self):
+        self.output.close_output()
+        self.clip_open = False
+        if self.pending:
+            self.swap()
+
+    # frames already buffered are kept, they're trimmed as new frames arrive
+    def set_buffer(self, buffer_ms):
+        self.buffer_ms = buffer_ms
+        self.output.buffer_duration_ms = buffer_ms
+
+    # returns the gap, (0, 0.0) if the bitrate is unchanged, or None if the swap waits for the open clip to close
+    def set_bitrate(self, bitrate):
+        if bitrate == self.bitrate and not self.pending:
+            return (0, 0.0)
+        self.bitrate = bitrate
+        if self.clip_open:
+            self.pending = True
+            return None
+        return self.swap()
+
+    def swap(self):
+        self.pending = False
+        f0, t0 = self.frames, self.clock()
+        # stopping the encoder stops its buffer, a new one starts with the new stream
+        self.camera.stop_encoder(self.encoder)
+        self.encoder = self.make_encoder(self.bitrate)
+        self.output  = self.make_output(self.buffer_ms)
+        self.camera.start_encoder(self.encoder, self.output)
+        self.gap = (self.frames - f0, self.clock() - t0)
+        return self.gap
+
+# side effects of a trigger (still encoding, review update, buzzer) run off the
+# decision thread. Jobs run in order on one worker, timed calls such as switching
+# the buzzer off fire from a heap, clock can be a fake for testing
+class TriggerEffects:
+    def __init__(self, clock=time.monotonic):
+        self.clock  = clock
+        self.jobs   = queue.Queue()
+        self.timers = []  # (due, seq, fn, args)
+        self.seq    = 0
+        self.ends   = {}  # device -> end of its latest pulse
+        self.cond   = threading.Condition()
+
+    def start(self):
+        for target in (self._run_jobs, self._run_timers):
+            threading.Thread(target=target, daemon=True).start()
+
+    # run fn(*args) on the worker, in the order submitted
+    def submit(self, fn, *args):
+        self.jobs.put((fn, args))
+
+    # run fn(*args) delay seconds from now
+    def after(self, delay, fn, *args):
+        with self.cond:
+            self.seq += 1
+            heapq.heappush(self.timers, (self.clock() + delay, self.seq, fn, args))
+            self.cond.notify()
+
+    # set device.value now and back to 0 after length seconds, a newer pulse extends it
+    def pulse(self, device, value, length):
+        device.value = value
+        end = self.clock() + length
+        self.ends[device] = end
+        self.after(length, self._pulse_off, device, end)
+
+    # block until submitted jobs have run
+    def wait(self):
+        self.jobs.join()
+
+    # fire the timers that are due, returns how many
+    def run_due(self):
+        n = 0
+        while True:
+            with self.cond:
+                if not self.timers or self.timers[0][0] > self.clock():
+                    return n
+                due, seq, fn, args = heapq.heappop(self.timers)
+            self._call(fn, args)
+            n += 1
+
+    def _pulse_off(self, device, end):
+        if self.ends.get(device) == end:
+            device.value = 0
+
+    def _call(self, fn, args):
+        try:
+            fn(*args)
+        except Exception as e:
+            print("Trigger effect failed", getattr(fn, '__name__', fn), e)
+
+    def _run_jobs(self):
+        while True:
+            fn, args = self.jobs.get()
+            self._call(fn, args)
+            self.jobs.task_done()
+
+    def _run_timers(self):
+        while True:
+            self.run_due()
+            with self.cond:
+                if not self.timers:
+                    self.cond.wait()
+                else:
+                    self.cond.wait(max(0, self.timers[0][0] - self.clock()))
+
+# captures keyed by their yymmdd_hhmmss timestamp, kept in an sqlite db with the
+# stills in a sorted in-memory list, so the review window never globs the folders
+class MediaCatalog:
+    def __init__(self, db_path, pictures, videos):
+        self.pictures = pictures
+        self.videos   = videos
+        self.lock     = threading.RLock()
+        self.db       = sqlite3.connect(db_path, check_same_thread=False)
+        self.db.execute("CREATE TABLE IF NOT EXISTS captures (stamp TEXT PRIMARY KEY, still INTEGER DEFAULT 0,"
+                        " clip INTEGER DEFAULT 0, duration REAL, frames INTEGER, size INTEGER, codec TEXT, class TEXT, score REAL)")
+        self.db.commit()
+        self.stamps    = []
+        self.pics      = []
+        self.clipstamp = []
+        self.unreadable = {}  # stamp: size of clips mp4_info couldn't read
+        self._load()
+
+    def still_path(self, stamp):
+        return os.path.join(self.pictures, stamp + ".jpg")
+
+    def clip_path(self, stamp):
+        return os.path.join(self.videos, stamp + ".mp4")
+
+    def _load(self):
+        # lists are updated in place, so callers can keep a reference
+        rows = self.db.execute("SELECT stamp, still, clip FROM captures ORDER BY stamp").fetchall()
+        self.stamps[:]    = [r[0] for r in rows if r[1]]
+        self.pics[:]      = [self.still_path(s) for s in self.stamps]
+        self.clipstamp[:] = [r[0] for r in rows if r[2]]
+
+    # reconcile with the folders, eg at start up or after bulk moves
+    def rescan(self):
+        stills = {os.path.basename(f)[:-4] for f in glob.glob(os.path.join(self.pictures, "*.jpg"))}
+        clips  = {os.path.basename(f)[:-4] for f in glob.glob(os.path.join(self.videos, "*.mp4"))}
+        with self.lock:
+            known = {r[0]: (r[1], r[2]) for r in self.db.execute("SELECT stamp, still, clip FROM captures")}
+            for stamp in stills | clips | set(known):
+                flags = (int(stamp in stills), int(stamp in clips))
+                if known.get(stamp) != flags:
+                    self.db.execute("INSERT INTO captures (stamp, still, clip) VALUES (?, ?, ?) ON CONFLICT(stamp)"
+                                    " DO UPDATE SET still = excluded.still, clip = excluded.clip", (stamp,) + flags)
+            self.db.execute("DELETE FROM captures WHERE still = 0 AND clip = 0")
+            self.db.commit()
+            self._load()
+
+    # re-check one capture's files, eg after a delete or move
+    def refresh(self, stamp):
+        with self.lock:
+            flags = (int(os.path.exists(self.still_path(stamp))), int(os.path.exists(self.clip_path(stamp))))
+            self.db.execute("INSERT INTO captures (stamp, still, clip) VALUES (?, ?, ?) ON CONFLICT(stamp)"
+                            " DO UPDATE SET still = excluded.still, clip = excluded.clip", (stamp,) + flags)
+            self.db.execute("DELETE FROM captures WHERE still = 0 AND clip = 0")
+            self.db.commit()
+            self._set(self.stamps, stamp, flags[0], self.pics, self.still_path(stamp))
+            self._set(self.clipstamp, stamp, flags[1])
+
+    def _set(self, stamps, stamp, present, paths=None, path=None):
+        i = bisect.bisect_left(stamps, stamp)
+        found = i < len(stamps) and stamps[i] == stamp
+        if present and not found:
+            stamps.insert(i, stamp)
+            if paths is not None:
+                paths.insert(i, path)
+        elif found and not present:
+            del stamps[i]
+            if paths is not None:
+                del paths[i]
+
+    def add_still(self, stamp, cls=None, score=None):
+        with self.lock:
+            self.db.execute("INSERT INTO captures (stamp, still, class, score) VALUES (?, 1, ?, ?) ON CONFLICT(stamp)"
+                            " DO UPDATE SET still = 1, class = excluded.class, score = excluded.score",
+                            (stamp, cls, None if score is None else float(score)))
+            self.db.commit()
+            self._set(self.stamps, stamp, 1, self.pics, self.still_path(stamp))
+
+    def add_clip(self, stamp, size=None):
+        with self.lock:
+            self.db.execute("INSERT INTO captures (stamp, clip, size) VALUES (?, 1, ?) ON CONFLICT(stamp)"
+                            " DO UPDATE SET clip = 1, size = coalesce(excluded.size, size)", (stamp, size))
+            self.db.commit()
+            self._set(self.clipstamp, stamp, 1)
+
+    def remove_still(self, stamp):
+        with self.lock:
+            self.db.execute("UPDATE captures SET still = 0 WHERE stamp = ?", (stamp,))
+            self.db.execute("DELETE FROM captures WHERE stamp = ? AND still = 0 AND clip = 0", (stamp,))
+            self.db.commit()
+            self._set(self.stamps, stamp, 0, self.pics)
+
+    def remove_clip(self, stamp):
+        with self.lock:
+            self.db.execute("UPDATE captures SET clip = 0 WHERE stamp = ?", (stamp,))
+            self.db.execute("DELETE FROM captures WHERE stamp = ? AND still = 0 AND clip = 0", (stamp,))
+            self.db.commit()
+            self._set(self.clipstamp, stamp, 0)
+
+    # clip metadata, from the recorder when it closes the clip or from the mp4 header
+    def set_clip_info(self, stamp, duration=None, frames=None, size=None, codec=None):
+        with self.lock:
+            self.db.execute("INSERT INTO captures (stamp, duration, frames, size, codec) VALUES (?, ?, ?, ?, ?)"
+                            " ON CONFLICT(stamp) DO UPDATE SET duration = coalesce(excluded.duration, duration),"
+                            " frames = coalesce(excluded.frames, frames), size = coalesce(excluded.size, size),"
+                            " codec = coalesce(excluded.codec, codec)", (stamp, duration, frames, size, codec))
+            self.db.commit()
+
+    # clip length in seconds, None if there's no clip. Clips recorded without
+    # metadata are read once with mp4_info and the result kept, unreadable ones
+    # aren't read again until their size changes
+    def duration(self, stamp):
+        if not self.has_clip(stamp):
+            return None
+        info = self.info(stamp)
+        if info is not None and info["duration"] is not None:
+            return info["duration"]
+        try:
+            size = os.path.getsize(self.clip_path(stamp))
+            if self.unreadable.get(stamp) == size:
+                return None
+            meta = mp4_info(self.clip_path(stamp))
+        except OSError:
+            return None
+        if meta is None:
+            self.unreadable[stamp] = size
+            return None
+        self.unreadable.pop(stamp, None)
+        self.set_clip_info(stamp, meta["duration"], meta["frames"], meta["size"], meta["codec"])
+        return meta["duration"]
+
+    def clear(self):
+        with self.lock:
+            self.db.execute("DELETE FROM captures")
+            self.db.commit()
+            self._load()
+
+    # sorted still paths, the same list object is kept up to date
+    def stills(self):
+        return self.pics
+
+    def clips(self):
+        return [self.clip_path(s) for s in self.clipstamp]
+
+    def has_clip(self, stamp):
+        i = bisect.bisect_left(self.clipstamp, stamp)
+        return i < len(self.clipstamp) and self.clipstamp[i] == stamp
+
+    # index of the first still at or after stamp
+    def seek(self, stamp):
+        return bisect.bisect_left(self.stamps, stamp)
+
+    def info(self, stamp):
+        keys = ("stamp", "still", "clip", "duration", "frames", "size", "codec", "class", "score")
+        with self.lock:
+            row = self.db.execute("SELECT " + ", ".join(keys) + " FROM captures WHERE stamp = ?", (stamp,)).fetchone()
+        if row is None:
+            return None
+        return dict(zip(keys, row))
+
+# mp4 boxes between start and end of f, as (type, payload start, box end)
+def mp4_boxes(f, start, end):
+    pos = start
+    while pos + 8 <= end:
+        f.seek(pos)
+        size, kind = struct.unpack(">I4s", f.read(8))
+        hlen = 8
+        if size == 1:
+            size = struct.unpack(">Q", f.read(8))[0]
+            hlen = 16
+        elif size == 0:
+            size = end - pos
+        if size < hlen:
+            return
+        yield kind, pos + hlen, min(pos + size, end)
+        pos += size
+
+def mp4_child(f, box, kind):
+    for k, s, e in mp4_boxes(f, box[0], box[1]):
+        if k == kind:
+            return s, e
+    return None
+
+def mp4_info(path):
+    """Duration, frame count, size and codec of an mp4 from its moov box headers,
+    without decoding anything. None if there's no moov (eg a clip still being written)
+    or the headers are cut short or malformed (eg a clip cut off by a power cut)."""
+    size = os.path.getsize(path)
+    with open(path, "rb") as f:
+        try:
+            return mp4_read(f, size)
+        except (struct.error, IndexError, ValueError):
+            return None
+
+# mp4_info from the open file f of the given size
+def mp4_read(f, size):
+    moov = mp4_child(f, (0, size), b"moov")
+    if moov is None:
+        return None
+    info = {"duration": None, "frames": None, "size": size, "codec": None}
+    mvhd = mp4_child(f, moov, b"mvhd")
+    if mvhd is not None:
+        f.seek(mvhd[0])
+        if f.read(1)[0] == 1:
+            f.seek(mvhd[0] + 20)
+            timescale, duration = struct.unpack(">IQ", f.read(12))
+        else:
+            f.seek(mvhd[0] + 12)
+            timescale, duration = struct.unpack(">II", f.read(8))
+        info["duration"] = duration / timescale if timescale else None
+    for kind, s, e in mp4_boxes(f, *moov):
+        if kind != b"trak":
+            continue
+        mdia = mp4_child(f, (s, e), b"mdia")
+        hdlr = mdia and mp4_child(f, mdia, b"hdlr")
+        if hdlr is None:
+            continue
+        f.seek(hdlr[0] + 8)
+        if f.read(4) != b"vide":
+            continue
+        stbl = mp4_child(f, mdia, b"minf")
+        stbl = stbl and mp4_child(f, stbl, b"stbl")
+        if stbl is None:
+            break
+        stsd = mp4_child(f, stbl, b"stsd")
+        if stsd is not None:
+            f.seek(stsd[0] + 12)
+            info["codec"] = f.read(4).decode("ascii", "replace")
+        stsz = mp4_child(f, stbl, b"stsz")
+        if stsz is not None:
+            f.seek(stsz[0] + 8)
+            info["frames"] = struct.unpack(">I", f.read(4))[0]
+        break
+    return info
+
+# review window sized thumbnails of the stills, written beside them in a thumbs folder,
+# with an LRU of decoded surfaces around the current position filled on a worker thread
+class ThumbCache:
+    def __init__(self, folder, size, capacity=32, radius=3):
+        self.folder   = folder
+        self.size     = size  # (w, h)
+        self.capacity = capacity
+        self.radius   = radius  # stills either side of the current one to prefetch
+        self.cache    = collections.OrderedDict()
+        self.lock     = threading.Lock()
+        self.jobs     = queue.Queue()
+        os.makedirs(folder, exist_ok=True)
+        threading.Thread(target=self._run, daemon=True).start()
+
+    def thumb_path(self, still):
+        return os.path.join(self.folder, os.path.basename(still))
+
+    # write the thumbnail of a new still, from the frame it was saved from
+    def make(self, still, frame):
+        self.jobs.put((still, frame))
+
+    # surface for a still, decoded now if it isn't cached
+    def get(self, still):
+        with self.lock:
+            surf = self.cache.get(still)
+            if surf is not None:
+                self.cache.move_to_end(still)
+                return surf
+        return self._load(still)
+
+    # load the stills around p in the background
+    def prefetch(self, stills, p):
+        for i in range(max(0, p - self.radius), min(len(stills), p + self.radius + 1)):
+            if stills[i] not in self.cache:
+                self.jobs.put((stills[i], None))
+
+    def forget(self, still):
+        with self.lock:
+            self.cache.pop(still, None)
+        try:
+            os.remove(self.thumb_path(still))
+        except OSError:
+            pass
+
+    # remove thumbnails whose still has gone, eg after a move to USB. The cache is
+    # keyed by still path and the files by still name, so both are matched on the name
+    def prune(self, stills):
+        keep = {os.path.basename(s) for s in stills}
+        with self.lock:
+            for still in [s for s in self.cache if os.path.basename(s) not in keep]:
+                del self.cache[still]
+        for name in os.listdir(self.folder):
+            if name not in keep:
+                try:
+                    os.remove(os.path.join(self.folder, name))
+                except OSError:
+                    pass
+
+    def _write(self, still, img):
+        thumb = cv2.resize(img, self.size, interpolation=cv2.INTER_AREA)
+        cv2.imwrite(self.thumb_path(still), thumb)
+
+    def _load(self, still):
+        path = self.thumb_path(still)
+        if not os.path.exists(path):
+            img = cv2.imread(still)
+            if img is None:
+                return pygame.Surface(self.size)
+            self._write(still, img)
+        surf = pygame.image.load(path)
+        if surf.get_size() != tuple(self.size):
+            surf = pygame.transform.scale(surf, self.size)
+        with self.lock:
+            self.cache[still] = surf
+            self.cache.move_to_end(still)
+            while len(self.cache) > self.capacity:
+                self.cache.popitem(last=False)
+        return surf
+
+    def _run(self):
+        while True:
+            still, frame = self.jobs.get()
+            try:
+                if frame is not None:
+                    self._write(still, frame)
+                elif still not in self.cache and os.path.exists(still):
+                    self._load(still)
+            except Exception as e:
+                print("Thumbnail failed", still, e)